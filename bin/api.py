@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from flask import Flask, jsonify, request, redirect, abort, url_for
+from flask import Flask, Response, jsonify, request, redirect, abort, url_for
 app = Flask(__name__)
 
 # configure cors
@@ -12,13 +12,20 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Methods', "*")
     return response
 
-import gr
-import gr_data
-import gr_types
+import noosphere as gr
+from noosphere import data as gr_data
+from noosphere.plugins import typing as gr_types
+from noosphere import feed
+from noosphere.shared import shared_graph
 
 import json
 import os
 
+# the graph stays loaded between requests, it is reloaded only when the file is changed by someone else
+# reads are served from the state after the last write, so they never wait for writers
+DATABASE = 'web.json'
+MAX_WAIT = 60 # seconds a request for changes waits for one at most
+
 # == Main ========================================================================
 
 #  # curl -X POST http://127.0.0.1:5000/graph/clear/
@@ -31,29 +38,89 @@ import os
     #  gr_types.init_link_sysem(graph)
     #  return '', 200
 
-# curl -X GET http://127.0.0.1:5000/node/find/ -H "Content-Type: application/json" --data '{"query": "lambda x:True"}'
+# curl -X GET http://127.0.0.1:5000/node/find/ -H "Content-Type: application/json" --data '{"query": "lambda x:True", "limit": 20}'
 @app.route('/node/find/', methods = ['GET'])
 def find():
-    graph = gr.Graph(gr_data.FileDB('web.json'))
     body = request.get_json()
     query_lambda = eval(body['query'])
-    res = graph.find(query_lambda)
-    #  print(res)
-    return str(res) + '\n', 200
+    with shared_graph(DATABASE).read() as graph:
+        res = list(graph.iter_find(query_lambda, body.get('offset', 0), body.get('limit'), body.get('after')))
+    return jsonify(res), 200
+
+# curl -X GET http://127.0.0.1:5000/node/aggregate/ -H "Content-Type: application/json" --data '{"aggregates": {"n": ["count", null]}, "group_by": "!abc123"}'
+@app.route('/node/aggregate/', methods = ['GET'])
+def aggregate():
+    body = request.get_json()
+    query_lambda = eval(body['query']) if 'query' in body else None
+    with shared_graph(DATABASE).read() as graph:
+        res = graph.aggregate(body['aggregates'], body.get('group_by'), query_lambda)
+    return jsonify(res), 200
+
+# curl -X GET "http://127.0.0.1:5000/changes/?after=12&timeout=30"
+# waits for changes committed after the sequence number, the answer holds the number to continue after
+@app.route('/changes/', methods = ['GET'])
+def changes():
+    query_lambda = eval(request.args['query']) if 'query' in request.args else None
+    timeout = min(request.args.get('timeout', MAX_WAIT, type=float), MAX_WAIT)
+    try:
+        (res, last) = shared_graph(DATABASE).changes(request.args.get('after', type=int), query_lambda, timeout)
+    except gr.NosError as e:
+        return jsonify({'error': str(e)}), 410 # the client has to fetch the nodes anew
+    return jsonify({'changes': [feed.plain(x) for x in res], 'last': last}), 200
+
+# curl -N http://127.0.0.1:5000/changes/stream/
+# server-sent events with sequence numbers as their ids, so a reconnecting client continues after Last-Event-ID
+@app.route('/changes/stream/', methods = ['GET'])
+def change_stream():
+    query_lambda = eval(request.args['query']) if 'query' in request.args else None
+    after = request.headers.get('Last-Event-ID', request.args.get('after'))
+    shared = shared_graph(DATABASE)
+    try:
+        (res, last) = shared.changes(None if after is None else int(after), query_lambda)
+    except gr.NosError as e:
+        return jsonify({'error': str(e)}), 410
+    def events(res, last):
+        while True:
+            if not res:
+                yield ': keep alive\n\n'
+            for change in res:
+                yield 'id: {}\ndata: {}\n\n'.format(change['seq'], json.dumps(feed.plain(change)))
+            (res, last) = shared.changes(last, query_lambda, MAX_WAIT)
+    return Response(events(res, last), mimetype='text/event-stream')
+
+# curl -X POST http://127.0.0.1:5000/materialized/ -H "Content-Type: application/json" --data '{"name": "big", "query": "lambda x: x.get(\"num\", 0) > 10", "projection": "lambda x: x[\"num\"]"}'
+@app.route('/materialized/', methods = ['POST'])
+def materialize():
+    body = request.get_json()
+    projection = eval(body['projection']) if 'projection' in body else None
+    with shared_graph(DATABASE).use() as graph:
+        graph.materialize(body['name'], eval(body['query']), projection)
+    return body, 200
+
+# curl -X GET http://127.0.0.1:5000/materialized/big/
+# results of materialized queries are published with each state, so reads do not wait for writers
+@app.route('/materialized/<name>/', methods = ['GET'])
+def materialized(name):
+    with shared_graph(DATABASE).read() as graph:
+        if name not in graph.materialized_views:
+            abort(404)
+        res = graph.materialized(name)
+    return jsonify(res), 200
 
 # old:  @app.route('/node/<int:entity_id>/', methods = ['GET'])
 
 # curl -X GET http://127.0.0.1:5000/node/101/
+# the ETag header holds the version of the node, see PUT
 @app.route('/node/<entity_id>/', methods = ['GET'])
 def get(entity_id):
-    graph = gr.Graph(gr_data.FileDB('web.json'))
-    return graph.get(entity_id), 200
+    with shared_graph(DATABASE).read() as graph:
+        return graph.get(entity_id), 200, {'ETag': str(graph.version(entity_id))}
 
 # curl -X GET http://127.0.0.1:5000/modules/
 @app.route('/modules/', methods = ['GET'])
 def get_modules():
-    graph = gr.Graph(gr_data.FileDB('web.json'))
-    return graph.get_modules(), 200
+    with shared_graph(DATABASE).read() as graph:
+        return graph.get_modules(), 200
 
 @app.route('/node/', methods = ['POST', 'PUT', 'OPTIONS'])
 def update_insert():
@@ -61,15 +128,21 @@ def update_insert():
     body = {}
     if request.method == 'POST':
         body = request.get_json()
-        graph = gr.Graph(gr_data.FileDB('web.json'))
-        graph.insert(body)
-# curl -X PUT http://127.0.0.1:5000/node/ -H "Content-Type: application/json" --data '{"id": 113, "test": "hello world"}'
+        with shared_graph(DATABASE).use() as graph:
+            graph.insert(body)
+# curl -X PUT http://127.0.0.1:5000/node/ -H "Content-Type: application/json" -H "If-Match: 3" --data '{"id": 113, "test": "hello world"}'
+# with If-Match the node is updated only if it still has the version, see ETag of GET
     elif request.method == 'PUT':
         body = request.get_json()
-        graph = gr.Graph(gr_data.FileDB('web.json'))
-        graph.update(body)
+        version = request.headers.get('If-Match')
+        with shared_graph(DATABASE).use() as graph:
+            graph.update(body, None if version is None else int(version.strip('"')))
     return body, 200
 
+@app.errorhandler(gr.ConflictError)
+def conflict(error):
+    return jsonify({'error': str(error)}), 409
+
 # == Main Initialization =========================================================
 
 if __name__ == '__main__':
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+'''
+Asynchronous variant of api.py which serves the same routes as an ASGI application.
+Results of find are streamed as newline-delimited json so that large results are never buffered whole.
+A query which fails after the first part was sent ends the stream with a line holding the error.
+
+Run it with any ASGI server, e.g., ``uvicorn asgi:app``.
+'''
+
+import json
+import asyncio
+import itertools
+import urllib.parse
+
+from noosphere import NosError, ConflictError, feed
+from noosphere.shared import shared_graph
+
+DATABASE = 'web.json'
+FIND_CHUNK = 100 # nodes sent in one part of the streamed response
+MAX_WAIT = 60 # seconds a request for changes waits for one at most
+POLL = 1.0 # seconds between checks for changes saved by other processes
+
+HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'*'),
+    (b'access-control-allow-methods', b'*'),
+]
+
+# == Main ========================================================================
+
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    method = scope['method']
+    path = scope['path']
+    try:
+        if path == '/node/find/' and method == 'GET':
+            await find(receive, send)
+        elif path == '/node/aggregate/' and method == 'GET':
+            await aggregate(receive, send)
+        elif path == '/changes/' and method == 'GET':
+            await changes(scope, send)
+        elif path == '/changes/stream/' and method == 'GET':
+            await change_stream(scope, send)
+        elif path == '/materialized/' and method == 'POST':
+            await materialize(receive, send)
+        elif path.startswith('/materialized/') and path.endswith('/') and method == 'GET':
+            await materialized(path[len('/materialized/'):-1], send)
+        elif path == '/modules/' and method == 'GET':
+            await get_modules(send)
+        elif path == '/node/' and method in ['POST', 'PUT', 'OPTIONS']:
+            await update_insert(method, scope, receive, send)
+        elif path.startswith('/node/') and path.endswith('/') and method == 'GET':
+            await get(path[len('/node/'):-1], send)
+        else:
+            await respond(send, 404, {'error': 'not found'})
+    except ConflictError as e:
+        await respond(send, 409, {'error': str(e)})
+    except NosError as e:
+        await respond(send, 400, {'error': str(e)})
+
+# curl -X GET http://127.0.0.1:8000/node/find/ -H "Content-Type: application/json" --data '{"query": "lambda x:True", "limit": 20}'
+async def find(receive, send):
+    body = await read_json(receive)
+    query_lambda = eval(body['query'])
+    error = b''
+    # the whole response comes from a single state of the graph which writers do not wait for
+    reading = shared_graph(DATABASE).read()
+    graph = await in_thread(reading.__enter__)
+    try:
+        nodes = graph.iter_find(query_lambda, body.get('offset', 0), body.get('limit'), body.get('after'))
+        # the scan runs in a thread so that other requests are served meanwhile,
+        # its first part is produced before the response starts so that a failing query is answered with an error
+        lines = await in_thread(find_chunk, nodes)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': HEADERS + [(b'content-type', b'application/x-ndjson')]})
+        while lines:
+            # waits until the client accepts the data so that slow clients are not buffered
+            await send({'type': 'http.response.body', 'body': lines, 'more_body': True})
+            try:
+                lines = await in_thread(find_chunk, nodes)
+            except Exception as e:
+                # the response has already started, so the error is its last line
+                (lines, error) = (b'', (json.dumps({'error': str(e)}) + '\n').encode('UTF-8'))
+    finally:
+        reading.__exit__(None, None, None)
+    await send({'type': 'http.response.body', 'body': error})
+
+# curl -X GET http://127.0.0.1:8000/node/aggregate/ -H "Content-Type: application/json" --data '{"aggregates": {"n": ["count", null]}, "group_by": "!abc123"}'
+async def aggregate(receive, send):
+    body = await read_json(receive)
+    query_lambda = eval(body['query']) if 'query' in body else None
+    def work():
+        with shared_graph(DATABASE).read() as graph:
+            return graph.aggregate(body['aggregates'], body.get('group_by'), query_lambda)
+    await respond(send, 200, await in_thread(work))
+
+# curl -X GET "http://127.0.0.1:8000/changes/?after=12&timeout=30"
+# waits for changes committed after the sequence number, the answer holds the number to continue after
+async def changes(scope, send):
+    args = query_args(scope)
+    query_lambda = eval(args['query']) if 'query' in args else None
+    after = int(args['after']) if 'after' in args else None
+    timeout = min(float(args.get('timeout', MAX_WAIT)), MAX_WAIT)
+    try:
+        (res, last) = await wait_changes(after, query_lambda, timeout)
+    except NosError as e:
+        await respond(send, 410, {'error': str(e)}) # the client has to fetch the nodes anew
+        return
+    await respond(send, 200, {'changes': [feed.plain(x) for x in res], 'last': last})
+
+# curl -N http://127.0.0.1:8000/changes/stream/
+# server-sent events with sequence numbers as their ids, so a reconnecting client continues after Last-Event-ID
+async def change_stream(scope, send):
+    args = query_args(scope)
+    query_lambda = eval(args['query']) if 'query' in args else None
+    after = dict(scope['headers']).get(b'last-event-id', args.get('after'))
+    try:
+        (res, last) = await wait_changes(None if after is None else int(after), query_lambda, None)
+    except NosError as e:
+        await respond(send, 410, {'error': str(e)})
+        return
+    await send({'type': 'http.response.start', 'status': 200, 'headers': HEADERS + [(b'content-type', b'text/event-stream')]})
+    while True:
+        if res:
+            events = ''.join('id: {}\ndata: {}\n\n'.format(x['seq'], json.dumps(feed.plain(x))) for x in res)
+        else:
+            events = ': keep alive\n\n'
+        await send({'type': 'http.response.body', 'body': events.encode('UTF-8'), 'more_body': True})
+        (res, last) = await wait_changes(last, query_lambda, MAX_WAIT)
+
+# curl -X POST http://127.0.0.1:8000/materialized/ -H "Content-Type: application/json" --data '{"name": "big", "query": "lambda x: x.get(\"num\", 0) > 10", "projection": "lambda x: x[\"num\"]"}'
+async def materialize(receive, send):
+    body = await read_json(receive)
+    (query_lambda, projection) = (eval(body['query']), eval(body['projection']) if 'projection' in body else None)
+    def work():
+        with shared_graph(DATABASE).use() as graph:
+            graph.materialize(body['name'], query_lambda, projection)
+    await in_thread(work)
+    await respond(send, 200, body)
+
+# curl -X GET http://127.0.0.1:8000/materialized/big/
+# results of materialized queries are published with each state, so reads do not wait for writers
+async def materialized(name, send):
+    def work():
+        with shared_graph(DATABASE).read() as graph:
+            return graph.materialized(name) if name in graph.materialized_views else None
+    res = await in_thread(work)
+    if res is None:
+        await respond(send, 404, {'error': 'not found'})
+        return
+    await respond(send, 200, res)
+
+# curl -X GET http://127.0.0.1:8000/node/!abc123/
+# the ETag header holds the version of the node, see PUT
+async def get(entity_id, send):
+    def work():
+        with shared_graph(DATABASE).read() as graph:
+            return (graph.get(entity_id), graph.version(entity_id))
+    (node, version) = await in_thread(work)
+    await respond(send, 200, node, [(b'etag', str(version).encode('UTF-8'))])
+
+# curl -X GET http://127.0.0.1:8000/modules/
+async def get_modules(send):
+    def work():
+        with shared_graph(DATABASE).read() as graph:
+            return graph.get_modules()
+    modules = await in_thread(work)
+    await respond(send, 200, modules)
+
+async def update_insert(method, scope, receive, send):
+    body = {}
+# curl -X POST http://127.0.0.1:8000/node/ -H "Content-Type: application/json" --data '{"asdf": 111}'
+    if method == 'POST':
+        body = await read_json(receive)
+        await in_thread(insert, body)
+# curl -X PUT http://127.0.0.1:8000/node/ -H "Content-Type: application/json" -H "If-Match: 3" --data '{"id": "!abc123", "test": "hello world"}'
+# with If-Match the node is updated only if it still has the version, see ETag of GET
+    elif method == 'PUT':
+        body = await read_json(receive)
+        version = dict(scope['headers']).get(b'if-match')
+        await in_thread(update, body, None if version is None else int(version.strip(b'"')))
+    await respond(send, 200, body)
+
+# == Utility functions ===========================================================
+
+async def in_thread(function, *args):
+    # calls which read or write the data run in a thread so that the event loop keeps serving other requests
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+def insert(node):
+    with shared_graph(DATABASE).use() as graph:
+        graph.insert(node)
+
+def update(node, version):
+    with shared_graph(DATABASE).use() as graph:
+        graph.update(node, version)
+
+def find_chunk(nodes):
+    return ''.join(json.dumps(x) + '\n' for x in itertools.islice(nodes, FIND_CHUNK)).encode('UTF-8')
+
+async def wait_changes(after, query_lambda, timeout):
+    # waiting clients hold no threads, they wait for an event which the feed sets
+    shared = shared_graph(DATABASE)
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        signal = change_signal(shared) # taken before the check so that no change is missed
+        # a thread is taken only to check the data which may be reloaded
+        (res, after) = await in_thread(shared.changes, after, query_lambda, 0)
+        remaining = None if deadline is None else deadline - loop.time()
+        if res or remaining is None or remaining <= 0:
+            return (res, after)
+        try:
+            await asyncio.wait_for(signal.wait(), min(POLL, remaining))
+        except asyncio.TimeoutError:
+            pass
+
+_signals = {} # shared graph -> event which is set and replaced when its feed publishes a change
+
+def change_signal(shared):
+    if shared not in _signals:
+        loop = asyncio.get_running_loop()
+        _signals[shared] = asyncio.Event()
+        # the feed calls back from whichever thread commits the change
+        shared.graph.feed.subscribe(lambda change: loop.call_soon_threadsafe(renew_signal, shared))
+    return _signals[shared]
+
+def renew_signal(shared):
+    (signal, _signals[shared]) = (_signals[shared], asyncio.Event())
+    signal.set()
+
+def query_args(scope):
+    return {x: y[-1] for (x, y) in urllib.parse.parse_qs(scope['query_string'].decode('UTF-8')).items()}
+
+async def read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body or b'{}')
+
+async def respond(send, status, content, headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': HEADERS + [(b'content-type', b'application/json')] + list(headers)})
+    await send({'type': 'http.response.body', 'body': json.dumps(content).encode('UTF-8')})
+
+# == Main Initialization =========================================================
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app)
@@ -3,9 +3,10 @@
 import sys
 import json
 
-import noosphere
-#  import gr_data
-#  import gr_types
+import noosphere as gr
+from noosphere import bulk
+from noosphere import data as gr_data
+from noosphere.plugins import typing as gr_types
 
 # == Main ========================================================================
 
@@ -21,7 +22,7 @@ def run_cmd(db_file, cmd):
         return False
     if cmd == '':
         print('The command is empty')
-    elif cmd in ['clear', 'ls', 'add', 'rem', 'modules']:
+    elif cmd in ['clear', 'ls', 'add', 'import', 'export', 'rem', 'modules']:
         db = gr_data.FileDB(db_file)
         if cmd == 'clear':
             graph = gr.Graph(db)
@@ -32,12 +33,19 @@ def run_cmd(db_file, cmd):
             return True
         elif cmd == 'ls':
             data = gr.Graph(db)
-            all_nodes = data.find()
-            print(json.dumps(all_nodes, indent=4))
+            bulk.export_nodes(data, sys.stdout)
+        elif cmd == 'export':
+            data = gr.Graph(db)
+            # newline-delimited json if the file ends with .ndjson or .jsonl
+            bulk.export_file(data, shift('Output File'))
         elif cmd == 'add':
             data = gr.Graph(db)
             entry = json.loads(input())
             data.insert(entry)
+        elif cmd == 'import':
+            data = gr.Graph(db)
+            # json array or newline-delimited json, written all at once
+            bulk.import_file(data, shift('Input File'))
         elif cmd == 'modules':
             data = gr.Graph(db)
             print(json.dumps(data.get_modules(), indent=4))
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import json
+import threading
 
-import gr
-from gr import unwrap
-import gr_types
-import gr_data
+import noosphere as gr
+from noosphere.utils import unwrap
+from noosphere.query import Eq, Range, Has
+from noosphere.shared import SharedGraph
+from noosphere.index import OverlayIndex
+from noosphere import binary, bulk, columnar
+from noosphere.identifier import AlphaNumId, IntId
+from noosphere.plugins import typing as gr_types
+from noosphere import data as gr_data
 
 test_file = '.test_tmp.json'
 
@@ -14,11 +22,32 @@ test_file = '.test_tmp.json'
 def test():
     print('testing')
     test_file_db()
+    test_binary_file_db()
+    test_log_file_db()
+    test_indexed_file_db()
+    test_sharded_file_db()
+    test_shared_graph()
+    test_concurrent_writers()
+    test_changes()
+    test_sqlite_db()
+    test_compact_db()
+    test_identifiers()
     test_basic_functionality()
+    test_batch()
+    test_indexes()
+    test_referrers()
+    test_traversal()
+    test_lazy_find()
+    test_aggregate()
+    test_materialized()
     test_simple_integrity()
     test_attribute_type_system()
     test_type_system()
     test_link_system()
+    test_link_system(gr_data.MemoryDB(trusted=True))
+    test_bulk_import()
+    test_export()
+    test_columnar()
 
 # == Utility functions ===========================================================
 
@@ -30,14 +59,14 @@ def insert_okay(graph, node):
 def insert_fails(graph, node):
     try:
         assert graph.insert(node) # fails on return
-    except gr.GrError:
+    except gr.NosError:
         pass
 
 # == Test functions ==============================================================
 
-def test_link_system():
+def test_link_system(data=None):
     print('Operations with link system')
-    graph = gr.Graph(gr_data.MemoryDB())
+    graph = gr.Graph(data or gr_data.MemoryDB())
     graph.clear()
     gr_types.init_attribute_id_system(graph)
     gr_types.init_link_sysem(graph)
@@ -47,7 +76,7 @@ def test_link_system():
     graph.insert(children_attr)
     parent_attr = gr_types.new_attr(graph, 'parent', 'ref')
     graph.insert(parent_attr)
-    children_attr = graph.get(children_attr)
+    children_attr = graph.view(children_attr).copy() # a trusted database returns the stored node by get
     children_attr[link_feat.get('target')] = gr.ref(parent_attr)
     graph.update(children_attr)
     parent_attr = graph.get(parent_attr)
@@ -61,7 +90,7 @@ def test_link_system():
     for (to, fr) in enumerate([0, 1, 1, 1, 3]): # parent list for nodes 1..
         to += 1
         fr_node = graph.find(lambda x: node_id_attr_id in x and x[node_id_attr_id] == fr)[0]
-        to_node = graph.find(lambda x: node_id_attr_id in x and x[node_id_attr_id] == to)[0]
+        to_node = dict(graph.find(lambda x: node_id_attr_id in x and x[node_id_attr_id] == to)[0])
         #  fr_node['children'].append(gr.ref(to_node)) # not needed thanks to links
         to_node[unwrap(parent_attr)] = gr.ref(fr_node)
         graph.update(to_node)
@@ -70,7 +99,160 @@ def test_link_system():
     # check that everyone has a parent
     for i in range(1, 6):
         assert graph.find(lambda x: node_id_attr_id in x and x[node_id_attr_id] == i)[0][unwrap(parent_attr)] is not None
+    # the other side of a rolled back link is restored, the stored nodes are not altered even if the database is trusted
+    moved = dict(graph.find(lambda x: x.get(node_id_attr_id) == 2)[0])
+    moved[unwrap(parent_attr)] = gr.ref(graph.find(lambda x: x.get(node_id_attr_id) == 0)[0])
+    try:
+        with graph.batch():
+            graph.update(moved)
+            raise gr.NosError('abort the batch')
+    except gr.NosError:
+        pass
+    assert len(graph.find(lambda x: x.get(node_id_attr_id) == 0)[0][unwrap(children_attr)]) == 1
+    assert len(graph.find(lambda x: x.get(node_id_attr_id) == 1)[0][unwrap(children_attr)]) == 3
+    graph.clear()
+
+def test_bulk_import():
+    print('Bulk import')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    gr_types.init_attribute_id_system(graph)
+    gr_types.init_link_sysem(graph)
+    link_feat = graph.module('link')
+    children_attr = gr_types.new_attr(graph, 'children', 'ref', True)
+    graph.insert(children_attr)
+    parent_attr = gr_types.new_attr(graph, 'parent', 'ref')
+    parent_attr[link_feat.get('target')] = gr.ref(children_attr)
+    graph.insert(parent_attr)
+    number_attr = gr_types.new_attr(graph, 'number', 'int')
+    graph.insert(number_attr)
+    (children, parent, number) = unwrap([children_attr, parent_attr, number_attr])
+    # labels are replaced by ids and the other sides of links are set
+    lines = [{'id': 'root', children: [], number: 0}]
+    lines += [{'id': 'child{}'.format(i), parent: {'id': 'root'}, number: i} for i in range(1, 4)]
+    source = io.StringIO('\n'.join(json.dumps(x) for x in lines))
+    labels = bulk.import_entries(graph, bulk.read_entries(source, read_size=7), batch_size=2)
+    root = graph.get(labels['root'])
+    assert sorted(unwrap(root[children])) == sorted(labels['child{}'.format(i)] for i in range(1, 4))
+    assert graph.get(labels['child2'])[parent] == {'id': labels['root']}
+    # json arrays are accepted as well and an invalid entry imports nothing
+    count = graph.count()
+    source = io.StringIO(json.dumps([{number: 10}, {number: 'eleven'}]))
+    try:
+        bulk.import_entries(graph, bulk.read_entries(source))
+        assert False
+    except gr.NosError:
+        pass
+    assert graph.count() == count
+    # batches committed before the invalid entry are removed again
+    source = io.StringIO(json.dumps([{number: 10}, {'id': 'ref', number: 11}, {parent: {'id': 'ref'}}, {number: 'eleven'}]))
+    try:
+        bulk.import_entries(graph, bulk.read_entries(source), batch_size=1)
+        assert False
+    except gr.NosError:
+        pass
+    assert graph.count() == count
+    # references which are neither labels nor existing nodes fail the import after all entries were inserted
+    source = io.StringIO(json.dumps([{number: 12}, {parent: {'id': 'missing'}}]))
+    try:
+        bulk.import_entries(graph, bulk.read_entries(source), batch_size=1)
+        assert False
+    except gr.NosError:
+        pass
+    assert graph.count() == count
+    source = io.StringIO(json.dumps([{number: 10}, {number: 11, parent: {'id': labels['root']}}]))
+    bulk.import_entries(graph, bulk.read_entries(source))
+    assert graph.count(Range(number, 10, 11)) == 2
+
+def test_export():
+    print('Export')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    gr_types.init_attribute_id_system(graph)
+    gr_types.init_type_system(graph)
+    type_feat = graph.module('type')
+    attr_type = type_feat.ref('attr_type')
+    output = io.StringIO()
+    count = bulk.export_nodes(graph, output, node_type=attr_type, ndjson=True)
+    nodes = [json.loads(x) for x in output.getvalue().splitlines()]
+    assert count == len(nodes) == graph.count(Eq(type_feat.get('type'), attr_type))
+    assert unwrap(nodes) == sorted(unwrap(nodes))
+    output = io.StringIO()
+    assert bulk.export_nodes(graph, output) == graph.count()
+    assert json.loads(output.getvalue()) == graph.find()
+    # a snapshot is not affected by later changes
+    snapshot = graph.data.snapshot()
+    node = graph.get(nodes[0])
+    node[type_feat.get('name')] = 'changed'
+    graph.update(node)
+    graph.insert({'val': 1})
+    assert snapshot[node['id']] == nodes[0]
+    assert len(snapshot) == graph.count() - 1
+
+def test_columnar():
+    print('Columnar store')
+    if columnar.numpy is None:
+        print('  skipped as numpy is not installed')
+        return
+    graph = gr.Graph(gr_data.MemoryDB())
     graph.clear()
+    gr_types.init_attribute_id_system(graph)
+    size_attr = gr_types.new_attr(graph, 'size', 'int')
+    graph.insert(size_attr)
+    weight_attr = gr_types.new_attr(graph, 'weight', 'float')
+    graph.insert(weight_attr)
+    (size, weight) = unwrap([size_attr, weight_attr])
+    nodes = [{size: i, weight: i / 2} for i in range(0, 100)]
+    for node in nodes[:50]:
+        graph.insert(node)
+    store = columnar.ColumnStore(graph)
+    assert {size, weight} <= set(store.columns)
+    # the columns follow changes of the graph
+    for node in nodes[50:]:
+        graph.insert(node)
+    nodes[0][size] = 1000
+    graph.update(nodes[0])
+    graph.remove(nodes[1])
+    assert store.count(size) == 99
+    assert store.max(size) == 1000 and store.min(size) == 2
+    assert store.sum(weight, store.mask(size, 90)) == sum(x / 2 for x in range(90, 100))
+    assert store.mean(size, store.equal_mask(size, 5)) == 5
+    assert sum(store.histogram(weight, bins=4)[0]) == 99
+    assert store.ids(store.mask(size, 10, 11)) == sorted(unwrap(nodes[10:12]))
+    # predicates are answered by the columns
+    assert graph.find(Range(size, 10, 11)) == sorted(nodes[10:12], key=unwrap)
+    assert graph.count(Eq(weight, 2.5)) == 1
+    nodes[2][size] = 2.5 # irregular values are found as well
+    graph.data.update(nodes[2])
+    assert graph.find(Range(size, 2, 3)) == sorted([nodes[2], nodes[3]], key=unwrap)
+    # nodes whose value is None have the attribute as well
+    graph.data.update({'id': nodes[3]['id'], size: None})
+    assert graph.count(Has(size)) == 99
+    store.close()
+    assert size not in graph.data.indexes
+    # indexes of the database are set aside rather than removed, snapshots keep their kind
+    data = gr_data.SqliteDB(test_file)
+    graph = gr.Graph(data)
+    graph.clear()
+    gr_types.init_attribute_id_system(graph)
+    size_attr = gr_types.new_attr(graph, 'size', 'int')
+    graph.insert(size_attr)
+    size = unwrap(size_attr)
+    data.add_index(size)
+    store = columnar.ColumnStore(graph, [size])
+    graph.insert({size: 1})
+    graph.insert({size: None})
+    assert graph.count(Has(size)) == 2
+    reader = data.reader()
+    assert reader.indexes[size].kind == 'sorted'
+    reader.close()
+    store.close()
+    loaded = gr_data.SqliteDB(test_file)
+    assert size in loaded.indexes
+    assert graph.count(Has(size)) == 2
+    loaded.close()
+    data.close()
+    os.remove(test_file)
 
 def test_type_system():
     print('Type system integrity checking')
@@ -136,6 +318,11 @@ def test_attribute_type_system():
     insert_okay(graph, node)
     node[id_map['arrrefpar']] = [gr.ref(test_type)]
     insert_okay(graph, node)
+    # altered attribute type is taken into account
+    strpar = graph.get(id_map['strpar'])
+    strpar[attr_type.get('dbtype')] = 'int'
+    graph.update(strpar)
+    insert_fails(graph, node)
     graph.clear()
 
 def test_simple_integrity():
@@ -176,9 +363,9 @@ def test_simple_integrity():
     insert_fails(graph, node) # arrays must be uniformly typed
     graph.clear()
 
-def test_basic_functionality():
+def test_basic_functionality(data=None):
     print('Graph elementary functionality')
-    graph = gr.Graph(gr_data.MemoryDB())
+    graph = gr.Graph(data or gr_data.MemoryDB())
     graph.clear()
     entity = {'name': 'test node'}
     graph.insert(entity)
@@ -192,6 +379,13 @@ def test_basic_functionality():
     entity_copy_via_find = graph.find(lambda x: True, [entity_id])[0]
     entity_copy_via_find['is_copy'] = True
     assert entity != entity_copy_via_find # the copy from find is not the original entity
+    entity_view = graph.view(entity_id)
+    assert entity == entity_view # view is equal to the entity
+    try:
+        entity_view['is_copy'] = True
+        assert False # view may not be altered
+    except TypeError:
+        pass
     for i in range(0, 10):
         graph.insert({'num': i})
     assert len(graph.find(lambda x: 'num' in x and x['num'] == 5)) == 1
@@ -210,6 +404,235 @@ def test_basic_functionality():
     assert len(graph.find()) == size-2 # removing of an entity by entity worked
     graph.clear()
 
+def test_batch():
+    print('Batched changes')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    node = {'num': 1}
+    with graph.batch():
+        graph.insert(node)
+        node['num'] = 2
+        graph.update(node)
+    assert graph.get(node)['num'] == 2
+    try:
+        with graph.batch():
+            node['num'] = 3
+            graph.update(node)
+            graph.insert({'num': 4})
+            raise gr.NosError('abort the batch')
+    except gr.NosError:
+        pass
+    assert graph.get(node)['num'] == 2 # changes were rolled back
+    assert len(graph.find(lambda x: 'num' in x)) == 1
+    # a rolled back inner batch keeps the changes of the outer one
+    logged = gr.Graph(gr_data.LogFileDB(test_file, compact_after=None))
+    logged.clear()
+    log_size = logged.data.log_size
+    with logged.batch():
+        outer = {'num': 5}
+        logged.insert(outer)
+        try:
+            with logged.batch():
+                logged.insert({'num': 6})
+                outer['num'] = 7
+                logged.update(outer)
+                raise gr.NosError('abort the inner batch')
+        except gr.NosError:
+            pass
+        assert logged.data.batch_depth == 1 and logged.get(outer)['num'] == 5
+        logged.insert({'num': 8})
+        assert logged.data.log_size == log_size # nothing is persisted before the outer batch ends
+    assert sorted(x['num'] for x in gr_data.LogFileDB(test_file).all() if 'num' in x) == [5, 8]
+    logged.data.clear()
+    graph.clear()
+    # repeated changes of a node are persisted once
+    data = gr_data.LogFileDB(test_file, compact_after=None)
+    entry = {'num': 1}
+    data.begin()
+    data.insert(entry)
+    entry['num'] = 5
+    data.update(entry)
+    data.commit()
+    assert data.log_size == 1
+    data.clear()
+
+def test_indexes(data=None):
+    print('Indexed queries')
+    graph = gr.Graph(data or gr_data.MemoryDB())
+    graph.clear()
+    graph.add_index('num', 'sorted')
+    graph.add_index('tags')
+    for i in range(0, 10):
+        graph.insert({'num': i, 'tags': ['even' if i % 2 == 0 else 'odd']})
+    assert len(graph.find(Eq('num', 5))) == 1
+    assert len(graph.find(Range('num', 3, 6))) == 4
+    assert len(graph.find(Range('num', low=8))) == 2
+    assert len(graph.find(Eq('tags', 'even') & Range('num', high=4))) == 3
+    assert len(graph.find(Has('tags'))) == 10
+    node = graph.find(Eq('num', 5))[0]
+    node['num'] = 50
+    graph.update(node)
+    assert len(graph.find(Eq('num', 5))) == 0 # index follows updates
+    assert len(graph.find(Range('num', low=10))) == 1
+    graph.remove(node)
+    assert len(graph.find(Range('num', low=10))) == 0 # index follows removals
+    with graph.batch():
+        graph.insert({'num': 100})
+        graph.rollback()
+    assert len(graph.find(Eq('num', 100))) == 0 # index follows rollbacks
+    graph.remove_index('num')
+    assert len(graph.find(Range('num', 3, 6))) == 3 # without index the nodes are scanned
+    graph.clear()
+
+def test_materialized():
+    print('Materialized queries')
+    graph = gr.Graph(gr_data.FileDB(test_file))
+    graph.clear()
+    nodes = [{'num': i} for i in range(6)]
+    for node in nodes:
+        graph.insert(node)
+    graph.materialize('big', lambda x: x.get('num', 0) > 3)
+    graph.materialize('numbers', Has('num'), lambda x: x['num'])
+    assert graph.materialized('big') == sorted(nodes[4:], key=lambda x: x['id'])
+    # results follow inserts, updates, removes, and rollbacks
+    nodes[0]['num'] = 10
+    graph.update(nodes[0])
+    graph.remove(nodes[5])
+    try:
+        with graph.batch():
+            graph.insert({'num': 20})
+            raise gr.NosError('rolled back')
+    except gr.NosError:
+        pass
+    assert graph.materialized_views['big'].ids() == sorted([nodes[0]['id'], nodes[4]['id']])
+    assert sorted(graph.materialized('numbers')) == [1, 2, 3, 4, 10]
+    # results are computed anew after a load
+    other = gr.Graph(gr_data.FileDB(test_file))
+    other.insert({'num': 30})
+    graph.reload()
+    assert sorted(graph.materialized('numbers')) == [1, 2, 3, 4, 10, 30]
+    # projections which return views of nodes are kept as plain data
+    graph.materialize('views', Has('num'), lambda x: x)
+    graph.materialize('parts', Has('num'), lambda x: {'num': x['num'], 'node': x})
+    assert json.dumps(graph.materialized('views')) and json.dumps(graph.materialized('parts'))
+    assert graph.materialized('views') == sorted(graph.find(Has('num')), key=lambda x: x['id'])
+    assert type(graph.materialized('parts')[0]['node']) is dict
+    # nodes on which the query or the projection fails do not match
+    graph.materialize('positive', lambda x: 'num' in x and x['num'] > 0, lambda x: 1 / (x['num'] - 1))
+    graph.insert({'num': 'x'})
+    graph.insert({'num': 0.0})
+    assert sorted(graph.materialized('positive')) == [1 / 29, 1 / 9, 1 / 3, 1 / 2, 1]
+    graph.materialize('zero', lambda x: x['num'] == 0)
+    assert len(graph.materialized('zero')) == 1
+    graph.remove_materialized('big')
+    try:
+        graph.materialized('big')
+        assert False
+    except gr.NosError:
+        pass
+    graph.data.clear()
+
+def test_aggregate():
+    print('Aggregation')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    owner = {'name': 'owner'}
+    graph.insert(owner)
+    for i in range(0, 10):
+        tags = ['even' if i % 2 == 0 else 'odd'] + (['small'] if i < 3 else [])
+        graph.insert({'hours': i, 'tags': tags, 'owner': gr.ref(owner)})
+    totals = graph.aggregate({'n': ('count', None), 'sum': ('sum', 'hours'), 'avg': ('avg', 'hours'), 'max': ('max', 'hours')})
+    assert totals == {'n': graph.count(), 'sum': 45, 'avg': 4.5, 'max': 9}
+    by_tag = graph.aggregate({'n': ('count', None), 'min': ('min', 'hours')}, group_by='tags')
+    assert by_tag[:3] == [{'group': 'even', 'n': 5, 'min': 0}, {'group': 'odd', 'n': 5, 'min': 1}, {'group': 'small', 'n': 3, 'min': 0}]
+    assert by_tag[3]['group'] is None # nodes without tags
+    assert graph.aggregate({'sum': ('sum', 'hours')}, 'owner', Range('hours', 5)) == [{'group': unwrap(owner), 'sum': 35}]
+    # counts of groups are answered by an index
+    counts = graph.aggregate({'n': ('count', None)}, group_by='tags')
+    graph.add_index('tags')
+    assert graph.aggregate({'n': ('count', None)}, group_by='tags') == counts
+
+def test_referrers(data=None):
+    print('Referencing nodes')
+    graph = gr.Graph(data or gr_data.MemoryDB())
+    graph.clear()
+    target = {'name': 'target'}
+    graph.insert(target)
+    single = {'ref': gr.ref(target)}
+    graph.insert(single)
+    multi = {'refs': [{'id': '!nodeid'}, gr.ref(target)]}
+    graph.insert(multi)
+    assert sorted(unwrap(graph.referrers(target))) == sorted([unwrap(single), unwrap(multi)])
+    assert unwrap(graph.referrers(target, 'refs')) == [unwrap(multi)]
+    try:
+        graph.remove(target)
+        assert False # referenced node cannot be removed
+    except gr.NosError:
+        pass
+    multi['refs'] = []
+    graph.update(multi)
+    assert unwrap(graph.referrers(target)) == [unwrap(single)]
+    graph.remove(single)
+    graph.remove(target)
+    graph.clear()
+
+def test_traversal(data=None):
+    print('Graph traversal')
+    graph = gr.Graph(data or gr_data.MemoryDB())
+    graph.clear()
+    # tree 0 -> 1, 2; 1 -> 3, 4; 3 -> 5 connected by children references
+    nodes = [{'num': i, 'children': []} for i in range(0, 6)]
+    for node in nodes:
+        graph.insert(node)
+    for (child, parent) in enumerate([None, 0, 0, 1, 1, 3]):
+        if parent is not None:
+            nodes[parent]['children'].append(gr.ref(nodes[child]))
+            nodes[child]['parent'] = gr.ref(nodes[parent])
+    for node in nodes:
+        graph.update(node)
+    ids = unwrap(nodes)
+    assert graph.neighbours(nodes[1], 'children') == sorted([ids[3], ids[4]])
+    assert graph.neighbours(nodes[1], 'children', 'in') == [ids[0]]
+    assert sorted(graph.neighbours(nodes[1], direction='both')) == sorted([ids[0], ids[3], ids[4]])
+    distances = dict(graph.traverse(nodes[0], 'children'))
+    assert distances == {ids[0]: 0, ids[1]: 1, ids[2]: 1, ids[3]: 2, ids[4]: 2, ids[5]: 3}
+    walk = [x for (x, _) in graph.traverse(nodes[0], 'children', order='dfs')]
+    assert walk.index(ids[5]) == walk.index(ids[3]) + 1 # depth-first goes down first
+    assert sorted(graph.k_hop(nodes[0], 2, 'children')) == sorted(ids[1:5])
+    assert graph.reachable(nodes[0], nodes[5], 'children')
+    assert not graph.reachable(nodes[5], nodes[0], 'children')
+    assert graph.shortest_path(nodes[5], nodes[2], 'parent') is None
+    assert graph.shortest_path(nodes[5], nodes[2], direction='both') == [ids[5], ids[3], ids[1], ids[0], ids[2]]
+    # the adjacency follows changes
+    nodes[2]['children'].append(gr.ref(nodes[5]))
+    graph.update(nodes[2])
+    assert graph.shortest_path(nodes[0], nodes[5], 'children') == [ids[0], ids[2], ids[5]]
+    graph.clear()
+
+def test_lazy_find():
+    print('Lazy and paginated find')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    for i in range(0, 10):
+        graph.insert({'num': i})
+    has_num = lambda x: 'num' in x
+    assert graph.count(has_num) == 10
+    assert graph.exists(lambda x: 'num' in x and x['num'] == 3)
+    assert not graph.exists(lambda x: 'num' in x and x['num'] == 10)
+    nodes = graph.find(has_num)
+    assert unwrap(list(graph.iter_find(has_num, offset=2, limit=3))) == unwrap(nodes[2:5])
+    # pages obtained via the id of the last node cover all nodes
+    pages = []
+    last_id = None
+    while True:
+        page = list(graph.iter_find(has_num, limit=4, after=last_id))
+        if not page:
+            break
+        pages += page
+        last_id = unwrap(page[-1])
+    assert pages == nodes
+    graph.clear()
+
 def test_file_db():
     print('FileDB implementation')
     data = gr_data.FileDB(test_file)
@@ -230,6 +653,425 @@ def test_file_db():
     # the file is successfully removed
     assert not os.path.exists(test_file)
 
+def test_binary_file_db():
+    print('BinaryFileDB implementation')
+    data = gr_data.BinaryFileDB(test_file)
+    node = {'int': -3, 'big': 2**70, 'float': 1.0, 'str': 'žluť', 'bool': False, 'none': None, 'arr': [1, 'a', True]}
+    data.insert(node)
+    data.insert({'ref': {'id': unwrap(node)}, 'refs': [{'id': unwrap(node)}], 'map': {'id': 1, 'x': {}}})
+    loaded = gr_data.BinaryFileDB(test_file)
+    assert loaded.all() == data.all()
+    # conversion to json and back round-trips exactly
+    json_file = test_file + '.export'
+    binary.export_json(test_file, json_file)
+    assert gr_data.FileDB(json_file).all() == data.all()
+    binary.import_json(json_file, test_file)
+    assert gr_data.BinaryFileDB(test_file).all() == data.all()
+    os.remove(json_file)
+    loaded.clear()
+    assert not os.path.exists(test_file)
+
+def test_log_file_db():
+    print('LogFileDB implementation')
+    data = gr_data.LogFileDB(test_file, compact_after=None)
+    first = {'val': 12}
+    second = {'arr': [1, 2, 3]}
+    data.insert(first)
+    data.insert(second)
+    first['val'] = 13
+    data.update(first)
+    data.remove(unwrap(second))
+    # changes are only appended to the log
+    assert os.path.exists(data.log_location)
+    assert data.log_size == 4
+    loaded = gr_data.LogFileDB(test_file, compact_after=None)
+    assert loaded.get(unwrap(first)) == first
+    assert loaded.get(unwrap(second)) is None
+    loaded.compact()
+    # compaction folds the log into the snapshot
+    assert not os.path.exists(loaded.log_location)
+    assert gr_data.LogFileDB(test_file).all() == [first]
+    # a record torn by an interrupted write is skipped and the later ones are kept
+    with open(loaded.log_location, "a", encoding='UTF-8') as file:
+        file.write('{"set":{"val":')
+    torn = gr_data.LogFileDB(test_file, compact_after=None)
+    third = {'val': 14}
+    torn.insert(third)
+    assert gr_data.LogFileDB(test_file, compact_after=None).all() == [first, third]
+    loaded.clear()
+    assert not os.path.exists(test_file)
+
+def test_indexed_file_db():
+    print('IndexedFileDB implementation')
+    data = gr_data.IndexedFileDB(test_file)
+    nodes = [{'val': i, 'arr': [i, i+1]} for i in range(0, 10)]
+    for node in nodes:
+        data.insert(node)
+    nodes[3]['val'] = 'changed'
+    data.update(nodes[3])
+    data.remove(unwrap(nodes[5]))
+    loaded = gr_data.IndexedFileDB(test_file)
+    # only the index is read on load
+    assert len(loaded.offsets) == 9 and not loaded.dirty
+    assert loaded.get(unwrap(nodes[3])) == nodes[3]
+    assert loaded.get(unwrap(nodes[5])) is None
+    assert sorted(unwrap(loaded.all())) == sorted(unwrap(nodes[:5] + nodes[6:]))
+    with loaded.snapshot() as snapshot:
+        loaded.compact()
+        assert loaded.garbage == 0
+        # the snapshot reads from the data file as it was
+        assert snapshot[unwrap(nodes[3])] == nodes[3]
+    assert gr_data.IndexedFileDB(test_file).get(unwrap(nodes[3])) == nodes[3]
+    # referrers of a removed node are found without decoding all nodes
+    loaded.insert({'ref': gr.ref(nodes[4])})
+    loaded = gr_data.IndexedFileDB(test_file)
+    assert len(loaded.other_referrers(unwrap(nodes[4]))) == 1
+    assert loaded.other_referrers(unwrap(nodes[3])) == []
+    assert loaded.refs.entries is None
+    # an index record torn by an interrupted write is skipped and the later ones are kept
+    with open(loaded.index_location, "a", encoding='UTF-8') as file:
+        file.write('["!torn",0,')
+    torn = gr_data.IndexedFileDB(test_file)
+    node = {'val': 'later'}
+    torn.insert(node)
+    assert gr_data.IndexedFileDB(test_file).get(unwrap(node)) == node
+    loaded.clear()
+    assert not os.path.exists(test_file)
+
+def test_sharded_file_db():
+    print('ShardedFileDB implementation')
+    test_dir = test_file + '.shards'
+    data = gr_data.ShardedFileDB(test_dir, shards=8)
+    nodes = [{'val': i} for i in range(0, 20)]
+    for node in nodes:
+        data.insert(node)
+    data.update({'id': '!0', 'modules': []})
+    shard = data._shard_number(unwrap(nodes[0]))
+    shard_location = data._shard_location(shard)
+    other_stats = {x: gr_data._stat(data._shard_location(x)) for x in range(0, 8) if x != shard}
+    nodes[0]['val'] = 'changed'
+    data.update(nodes[0])
+    # only the shard of the changed node is rewritten
+    assert other_stats == {x: gr_data._stat(data._shard_location(x)) for x in other_stats}
+    loaded = gr_data.ShardedFileDB(test_dir)
+    assert loaded.get('!0') == {'id': '!0', 'modules': []}
+    assert not loaded.shards
+    assert loaded.get(unwrap(nodes[0])) == nodes[0]
+    assert list(loaded.shards) == [shard]
+    assert sorted(unwrap(loaded.all())) == sorted(unwrap(nodes) + ['!0'])
+    # a change made by another process is noticed
+    data.remove(unwrap(nodes[0]))
+    assert loaded.stale()
+    loaded.load()
+    assert loaded.get(unwrap(nodes[0])) is None
+    # referrers of a removed node are found reading only the shards which contain the reference
+    data.insert({'ref': gr.ref(nodes[1])})
+    loaded.load()
+    assert len(loaded.other_referrers(unwrap(nodes[1]))) == 1
+    assert len(loaded.shards) < 8 and loaded.refs.entries is None
+    assert loaded.other_referrers(unwrap(nodes[2])) == []
+    # snapshots share the loaded shards and read the others when they are asked for
+    with loaded.snapshot() as snapshot:
+        count = len(loaded.shards)
+        node = loaded.get(unwrap(nodes[3]))
+        node['val'] = 'changed'
+        loaded.update(node)
+        assert snapshot[unwrap(nodes[3])]['val'] == 3 and loaded.get(unwrap(nodes[3]))['val'] == 'changed'
+        assert len(snapshot) == len(loaded.keys())
+        assert count < 8
+    # writers of the same shard keep the nodes of each other and changes of the same node conflict
+    (first, second) = (gr_data.ShardedFileDB(test_dir), gr_data.ShardedFileDB(test_dir))
+    by_shard = {}
+    for key in unwrap(nodes[4:]):
+        by_shard.setdefault(first._shard_number(key), []).append(key)
+    pair = next(x for x in by_shard.values() if len(x) > 1)
+    (node, other) = (first.get(pair[0]), second.get(pair[1]))
+    node['val'] = 'first'
+    first.update(node)
+    other['val'] = 'second'
+    second.update(other)
+    reloaded = gr_data.ShardedFileDB(test_dir)
+    assert reloaded.get(unwrap(node)) == node and reloaded.get(unwrap(other)) == other
+    node['val'] = 'again'
+    second.update(node)
+    mine = first.get(unwrap(node))
+    mine['val'] = 'mine'
+    try:
+        first.update(mine)
+        assert False
+    except gr.ConflictError:
+        pass
+    assert first.get(unwrap(node)) == node
+    loaded.clear()
+    assert not os.path.exists(shard_location)
+    os.rmdir(test_dir)
+
+def test_shared_graph():
+    print('Shared graph')
+    shared = SharedGraph(gr_data.FileDB(test_file))
+    with shared.use() as graph:
+        graph.clear()
+        graph.insert({'num': 1})
+        assert not graph.data.stale() # own changes do not need a reload
+    other = gr.Graph(gr_data.FileDB(test_file))
+    other.insert({'num': 2})
+    with shared.use() as graph:
+        assert len(graph.find(lambda x: 'num' in x)) == 2 # reloaded after a change by someone else
+    # readers see the state after the last write whatever is written meanwhile
+    with shared.read() as reader:
+        with shared.use() as graph:
+            graph.insert({'num': 3})
+            assert reader.count(lambda x: 'num' in x) == 2
+        assert reader.count(lambda x: 'num' in x) == 2
+        with shared.read() as other_reader:
+            assert other_reader.count(lambda x: 'num' in x) == 3
+        try:
+            reader.insert({'num': 4})
+            assert False
+        except gr.NosError:
+            pass
+    # published states reuse the built indexes of the previous ones
+    with shared.use() as graph:
+        graph.add_index('num', 'sorted')
+        target = {'num': 10}
+        graph.insert(target)
+        graph.insert({'num': 11, 'ref': gr.ref(target)})
+    with shared.read() as reader:
+        assert reader.count(Range('num', 10, 11)) == 2 and len(reader.referrers(target)) == 1
+    with shared.use() as graph:
+        graph.remove(graph.find(Eq('num', 11))[0])
+        graph.insert({'num': 12})
+    with shared.read() as reader:
+        assert isinstance(reader.data.indexes['num'], OverlayIndex)
+        assert reader.count(Range('num', 10, 12)) == 2 and reader.referrers(target) == []
+        assert reader.count(Has('num')) == 5
+    # readers share the indexes which are built once
+    with shared.use() as graph:
+        graph.add_index('num', 'hash')
+        graph.insert({'num': 13})
+    with shared.read() as reader:
+        assert not reader.data.indexes['num'].built()
+        counts = []
+        threads = [threading.Thread(target=lambda: counts.append(reader.count(Has('num')))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counts == [6] * 8
+    # results of materialized queries are read from the published states without the writer lock
+    with shared.use() as graph:
+        graph.materialize('numbers', Has('num'), lambda x: x['num'])
+    with shared.read() as reader:
+        with shared.use() as graph:
+            graph.insert({'num': 14})
+            assert sorted(reader.materialized('numbers')) == [1, 2, 3, 10, 12, 13]
+    with shared.read() as reader:
+        assert sorted(reader.materialized('numbers')) == [1, 2, 3, 10, 12, 13, 14]
+    with shared.use() as graph:
+        graph.data.clear()
+    assert not os.path.exists(test_file)
+
+def test_concurrent_writers():
+    print('Concurrent writers')
+    for database in [gr_data.FileDB, gr_data.LogFileDB]:
+        first = gr.Graph(database(test_file))
+        first.clear()
+        (a, b) = ({'num': 1}, {'num': 2})
+        first.insert(a)
+        first.insert(b)
+        second = gr.Graph(database(test_file))
+        a['num'] = 10
+        first.update(a)
+        b['num'] = 20
+        second.update(b) # changes of other nodes are merged
+        third = gr.Graph(database(test_file))
+        assert third.get(a)['num'] == 10 and third.get(b)['num'] == 20
+        # the node was changed by another process since it was loaded
+        b = first.get(b)
+        b['num'] = 30
+        try:
+            first.update(b)
+            assert False
+        except gr.ConflictError:
+            pass
+        assert first.get(b)['num'] == 20
+        # compare and swap within a process
+        version = first.version(a)
+        first.update(first.get(a), version)
+        try:
+            first.update(first.get(a), version)
+            assert False
+        except gr.ConflictError:
+            pass
+        first.data.clear()
+
+def test_changes():
+    print('Change feed')
+    graph = gr.Graph(gr_data.MemoryDB())
+    graph.clear()
+    start = graph.last_change()
+    received = []
+    subscription = graph.subscribe(received.append, lambda x: x.get('num', 0) > 1)
+    node = {'num': 1}
+    graph.insert(node)
+    node['num'] = 2
+    graph.update(node)
+    with graph.batch():
+        other = {'num': 3}
+        graph.insert(other)
+        other['num'] = 4
+        graph.update(other)
+    try:
+        with graph.batch():
+            graph.remove(node)
+            raise gr.NosError('rolled back')
+    except gr.NosError:
+        pass
+    changes = graph.changes(start)
+    assert [(x['op'], x['id']) for x in changes] == [('insert', node['id']), ('update', node['id']), ('insert', other['id'])]
+    assert changes[1]['before'] == {'num': 1, 'id': node['id']} and changes[2]['after']['num'] == 4
+    assert [x['seq'] for x in received] == [x['seq'] for x in changes[1:]]
+    # resuming after a change
+    subscription.cancel()
+    graph.remove(node)
+    assert [x['op'] for x in graph.changes(changes[-1]['seq'])] == ['remove'] and len(received) == 2
+    resumed = []
+    graph.subscribe(resumed.append, after=changes[0]['seq'])
+    assert [x['seq'] for x in resumed] == [x['seq'] for x in changes[1:]] + [graph.last_change()]
+    try:
+        graph.changes(graph.last_change() + 1)
+        assert False
+    except gr.NosError:
+        pass
+    # changes saved by another process are found from versions after a reload
+    shared = SharedGraph(gr_data.FileDB(test_file))
+    with shared.use() as graph:
+        graph.clear()
+    (_, last) = shared.changes()
+    other = gr.Graph(gr_data.FileDB(test_file))
+    other.insert({'num': 5})
+    (changes, last) = shared.changes(last, timeout=10, poll=0.01)
+    assert [(x['op'], x['after']['num']) for x in changes] == [('insert', 5)]
+    assert shared.changes(last, timeout=0) == ([], last)
+    with shared.use() as graph:
+        graph.data.clear()
+    # merged and replayed changes are published once the state is final, only those of the other process
+    for database in [gr_data.FileDB, gr_data.LogFileDB]:
+        first = gr.Graph(database(test_file))
+        first.clear()
+        node = {'num': 6}
+        first.insert(node)
+        second = gr.Graph(database(test_file))
+        inserted = {'num': 7}
+        second.insert(inserted)
+        start = first.last_change()
+        node['num'] = 8
+        first.update(node)
+        assert [(x['op'], x['id']) for x in first.changes(start)] == [('update', node['id']), ('insert', inserted['id'])]
+        start = second.last_change()
+        second.reload()
+        assert [(x['op'], x['id']) for x in second.changes(start)] == [('update', node['id'])]
+        # a change which conflicts is not published, the saved one is
+        start = first.last_change()
+        changed = second.get(node)
+        changed['num'] = 9
+        second.update(changed)
+        node['num'] = 10
+        try:
+            first.update(node)
+            assert False
+        except gr.ConflictError:
+            pass
+        assert [(x['op'], x['after']['num']) for x in first.changes(start)] == [('update', 9)]
+        first.data.clear()
+
+def test_sqlite_db():
+    print('SqliteDB implementation')
+    for test_graph in [test_basic_functionality, test_indexes, test_referrers, test_traversal]:
+        data = gr_data.SqliteDB(test_file)
+        test_graph(data)
+        data.close()
+    data = gr_data.SqliteDB(test_file)
+    entity = {'val': 12, 'arr': [1, 2, 3]}
+    data.insert(entity)
+    loaded = gr_data.SqliteDB(test_file)
+    # what is saved is the same as what is retrieved
+    assert loaded.get(unwrap(entity)) == entity
+    with loaded.snapshot() as snapshot:
+        data.remove(unwrap(entity))
+        assert snapshot[unwrap(entity)] == entity
+        assert unwrap(entity) in list(snapshot)
+    loaded.close()
+    data.close()
+    os.remove(test_file)
+
+def test_compact_db():
+    print('CompactDB implementation')
+    for test_graph in [test_basic_functionality, test_indexes, test_referrers]:
+        test_graph(gr_data.CompactDB())
+    data = gr_data.CompactDB()
+    target = {'val': 1}
+    data.insert(target)
+    entity = {'val': 12, 'arr': [1, 2, 3], 'ref': gr.ref(target), 'refs': [gr.ref(target), None], 'none': None}
+    data.insert(entity)
+    # nodes are stored compactly but retrieved unchanged
+    assert data.get(unwrap(entity)) == entity
+    assert isinstance(data.get(unwrap(entity))['arr'], list)
+    stored = data.db[unwrap(entity)]
+    assert stored[0] == tuple(entity) and stored[3] is stored[4][0]
+    retrieved = data.get(unwrap(entity))
+    retrieved['arr'].append(4)
+    assert data.get(unwrap(entity)) == entity
+
+def test_identifiers():
+    print('Identifiers')
+    data = gr_data.MemoryDB()
+    ids = data.ids.new_ids(data, 1000)
+    assert len(set(ids)) == 1000 and all(data.is_id(x) for x in ids)
+    entries = [{'val': i} for i in range(10)]
+    data.insert_many(entries)
+    assert all(data.contains(x['id']) and data.get(x['id']) == x for x in entries)
+    # used ids are skipped, here all but one of the ids of length one
+    allocator = AlphaNumId(1)
+    used = allocator.new_ids(data, 61)
+    class Used:
+        def contains(self, entry_id):
+            return entry_id in used
+    assert allocator.new_id(Used()) not in used
+    # integer ids are reserved in blocks which survive saving and loading
+    allocator = IntId()
+    assert allocator.new_ids(data, 3) == [100, 101, 102]
+    state = allocator.save()
+    assert state['last_id'] >= 103
+    other = IntId()
+    other.load(state)
+    assert other.new_id(data) == state['last_id']
+    # processes sharing a file get distinct blocks, which neither loads nor rollbacks give up
+    class IntIdFileDB(gr_data.FileDB):
+        def load(self):
+            if not isinstance(self.ids, IntId):
+                (self.orig_ids, self.ids) = (IntId(), IntId())
+            super().load()
+    first = IntIdFileDB(test_file)
+    first.clear()
+    second = IntIdFileDB(test_file)
+    entries = [{'val': i} for i in range(4)]
+    first.insert(entries[0])
+    second.insert(entries[1])
+    assert entries[1]['id'] >= entries[0]['id'] + IntId.BLOCK
+    first.load()
+    first.begin()
+    first.insert(entries[2])
+    first.rollback()
+    first.insert(entries[3])
+    assert entries[3]['id'] == entries[0]['id'] + 2
+    # merging with what another process saved never moves the ids state back
+    second.insert({'val': 4})
+    first.insert({'val': 5})
+    assert first.ids.save() == second.ids.save()
+    first.clear()
+    assert not any(os.path.exists(test_file + x) for x in ['', '.ids', '.lock'])
+
 # == Test invocation =============================================================
 
 if __name__ == '__main__':
@@ -2,21 +2,51 @@
 This is root of the Noosphere project. For an concept explanation and examples refer to the documentation http://noosphere.readthedocs.io/
 '''
 
+import itertools
+import contextlib
+from collections import namedtuple
+
+from noosphere import traversal
 from noosphere.utils import ref, wrap, unwrap
 
 class NosError(RuntimeError):
     pass
 
+class ConflictError(NosError):
+    '''nodes were changed by someone else since the changes were based on them'''
+
 class Module:
     def __init__(self, data):
         self.data = data
     def get(self, name):
         return unwrap(self.data[name])
     def ref(self, name):
-        return self.data[name]
+        return ref(self.data[name])
     def id(self):
         return self.data['id']
 
+# description of an attribute given by the attribute_id and link modules, missing properties are None
+Attribute = namedtuple('Attribute', ['id', 'dbtype', 'array', 'target'])
+
+class MetaCache:
+    '''
+    Modules and attribute descriptors resolved from the graph.
+    They are dropped whenever a node they were read from or the root loader changes.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def changed(self, node_id, old_node, new_node):
+        if node_id in self.sources or node_id == '!0':
+            self.reset()
+
+    def reset(self):
+        self.modules = {}
+        self.attributes = {}
+        self.validators = {}
+        self.sources = set()
+
 def new_module(graph, scope, name, version):
     loader = graph.module('loader', True)
     link_loader = {
@@ -29,8 +59,14 @@ def new_module(graph, scope, name, version):
 class Graph:
 
     def __init__(self, data):
+        from noosphere.feed import ChangeFeed # the module depends on this one
         self.data = data
+        self.cache = MetaCache()
+        self.data.listeners.append(self.cache)
         self.data.load()
+        self.feed = ChangeFeed(self.data)
+        self.data.listeners.append(self.feed)
+        self.materialized_views = {}
         self._run_loaders()
 
     #== Root loader functions ==================================================
@@ -56,24 +92,50 @@ class Graph:
         root_loader = {'id':'!0','modules':[ref(loader)]}
         self.data.update(root_loader)
         self.modules = {'loader': loader}
+        self.cache.reset()
 
     def add_module(self, node):
         root_loader = self._get_root_loader()
         if root_loader is None or 'modules' not in root_loader:
             raise NosError('Root loader is not initialized.')
+        root_loader = self.view(root_loader).copy() # the stored node is never altered, even if the database is trusted
         root_loader['modules'].append(ref(node))
         self.update(root_loader)
         self._run_loaders()
 
     def module(self, name, compulsory=False):
+        if name in self.cache.modules:
+            return self.cache.modules[name]
         if name is not None and name in self.modules:
             res_feat = self.get(self.modules[name])
             if res_feat:
-                return Module(res_feat)
+                self.cache.modules[name] = Module(res_feat)
+                self.cache.sources.add(res_feat['id'])
+                return self.cache.modules[name]
         if not compulsory:
             return None
         raise NosError('unable to find "{}" module in {}'.format(name, self.modules))
 
+    def attribute(self, attr_id):
+        '''returns the description of the attribute with the given id'''
+        if attr_id in self.cache.attributes:
+            return self.cache.attributes[attr_id]
+        attr = self.view(attr_id)
+        attr_feat = self.module('attribute_id')
+        link_feat = self.module('link')
+        dbtype = None
+        array = None
+        target = None
+        if attr_feat:
+            dbtype = attr.get(attr_feat.get('dbtype'))
+            array = attr.get(attr_feat.get('array'))
+        if link_feat and attr.get(link_feat.get('target')):
+            target = unwrap(attr[link_feat.get('target')])
+        res = Attribute(attr_id, dbtype, array, target)
+        self.cache.attributes[attr_id] = res
+        self.cache.sources.add(attr_id)
+        return res
+
     def _get_root_loader(self):
         try:
             return self.get('!0')
@@ -83,7 +145,7 @@ class Graph:
     def _run_loaders(self):
         new_modules = {}
         root_loader = self._get_root_loader()
-        if not hasattr(self, 'modules'):
+        if not hasattr(self, 'modules') and root_loader is not None: # an empty database has no modules yet
             self.modules = {'loader': root_loader['modules'][0]}
         if root_loader is not None:
             assert 'modules' in root_loader
@@ -94,10 +156,16 @@ class Graph:
                 if name_id in module:
                     new_modules[module[name_id]] = module
         self.modules = new_modules
+        self.cache.reset()
 
     def get_modules(self):
         return self.modules
 
+    def reload(self):
+        '''load the data again, e.g., after another process changed them'''
+        self.data.load()
+        self._run_loaders()
+
     #== Functions for elementary operations ====================================
 
     def get_id(self, entry_or_id):
@@ -111,21 +179,108 @@ class Graph:
 
     def find(self, filter_lambda=None, ids=None):
         '''given a query function returns all nodes which equal on the given structure'''
+        if filter_lambda is None:
+            filter_lambda = lambda x: True
         if ids is None:
-            entries = self.data.all()
-        else:
-            entries = [self.get(x) for x in ids]
+            return list(self.iter_find(filter_lambda))
+        # the query sees read-only views so that only the matching nodes are copied
+        entries = [x for x in map(self.view, ids) if filter_lambda(x)]
+        return [self.data.materialize(x) for x in entries]
+
+    def iter_find(self, filter_lambda=None, offset=0, limit=None, after=None):
+        '''
+        Lazily yields nodes which satisfy the query ordered by their ids.
+        The first offset of them are skipped and at most limit of them are returned.
+        Next page is obtained by passing id of the last returned node as after.
+        '''
+        matching = self._matching(filter_lambda, after)
+        stop = None if limit is None else offset + limit
+        for view in itertools.islice(matching, offset, stop):
+            yield self.data.materialize(view)
+
+    def count(self, filter_lambda=None):
+        '''number of nodes which satisfy the query, no node is copied'''
+        return sum(1 for _ in self._matching(filter_lambda))
+
+    def exists(self, filter_lambda=None):
+        '''whether any node satisfies the query, no node is copied'''
+        return any(True for _ in self._matching(filter_lambda))
+
+    def _matching(self, filter_lambda, after=None):
         if filter_lambda is None:
             filter_lambda = lambda x: True
-        return [x for x in entries if filter_lambda(x)]
+        return self.data.query(filter_lambda, after)
+
+    def aggregate(self, aggregates, group_by=None, filter_lambda=None):
+        '''
+        Computes aggregates of nodes which satisfy the query in a single pass without copying them.
+        Aggregates map result names to pairs of a function (count, sum, min, max, or avg) and an attribute,
+        e.g., {'tasks': ('count', None), 'hours': ('sum', hours_attr)}; see noosphere.aggregate.
+        When grouped by an attribute, a list of results is returned, each with its value under "group".
+        '''
+        from noosphere.aggregate import Aggregation # the module depends on this one
+        aggregates = {x: (f, None if y is None else self._attr_id(y)) for (x, (f, y)) in aggregates.items()}
+        group_by = None if group_by is None else self._attr_id(group_by)
+        aggregation = Aggregation(aggregates, group_by)
+        index = self.data.indexes.get(group_by)
+        only_counted = all(x == ('count', None) for x in aggregates.values())
+        if filter_lambda is None and only_counted and hasattr(index, 'counts'):
+            # sizes of the groups are known to the index
+            aggregation.add_counts(index.counts(), len(self.data.keys()) - len(index.having()))
+        else:
+            for view in self._matching(filter_lambda):
+                aggregation.add(view)
+        return aggregation.results()
+
+    def add_index(self, attr, kind='hash'):
+        '''index values of the attribute so that find with predicates from noosphere.query need not scan all nodes'''
+        self.data.add_index(self._attr_id(attr), kind)
+
+    def remove_index(self, attr):
+        self.data.remove_index(self._attr_id(attr))
+
+    def materialize(self, name, predicate, projection=None):
+        '''
+        Keeps nodes which satisfy the query, or their projections, up to date as nodes change, see materialized.
+        The query and the projection are given single nodes and should not depend on other ones.
+        '''
+        from noosphere.materialized import MaterializedView # the module depends on this one
+        self.remove_materialized(name)
+        view = MaterializedView(self.data, predicate, projection)
+        self.materialized_views[name] = view
+        self.data.listeners.append(view)
+
+    def materialized(self, name):
+        '''nodes of the materialized query ordered by their ids, or their projections, without scanning the graph'''
+        if name not in self.materialized_views:
+            raise NosError('there is no materialized query {}, the known are {}'.format(name, sorted(self.materialized_views)))
+        return self.materialized_views[name].rows()
+
+    def remove_materialized(self, name):
+        view = self.materialized_views.pop(name, None)
+        if view is not None:
+            self.data.listeners.remove(view)
+
+    def _attr_id(self, attr):
+        # attributes are given either by their node or by their id or name
+        if isinstance(attr, str):
+            return attr
+        return self.get_id(attr)
 
     def get(self, entry_or_id):
         '''returns the up-to-date version of the entry given entry or its id'''
+        return self._retrieve(entry_or_id, self.data.get)
+
+    def view(self, entry_or_id):
+        '''returns a read-only view of the entry which is cheaper than get'''
+        return self._retrieve(entry_or_id, self.data.view)
+
+    def _retrieve(self, entry_or_id, retrieve):
         assert entry_or_id is not None
         node_id = self.get_id(entry_or_id)
         if not self.data.is_id(node_id):
             raise NosError('node_id should be int, it is ' + str(type(node_id)))
-        node = self.data.get(node_id)
+        node = retrieve(node_id)
         if node is None:
             raise NosError('node with id ' + str(node_id) + ' could not be found')
         return node
@@ -134,25 +289,146 @@ class Graph:
         '''create a new entry and assign a new id to the node'''
         assert new_entry is not None
         self.valid_entry(new_entry)
-        self.data.insert(new_entry)
-        self.set_other_side_of_references({}, new_entry)
+        with self.batch():
+            self.data.insert(new_entry)
+            self.set_other_side_of_references({}, new_entry)
 
-    def update(self, entry):
-        '''alter an existing entry'''
+    def update(self, entry, version=None):
+        '''alter an existing entry, if the version is given only when the entry still has it'''
         assert entry is not None
         self.valid_entry(entry)
         old_entry = self.get(entry)
-        self.data.update(entry)
-        self.set_other_side_of_references(old_entry, entry)
+        if version is not None and self.version(entry) != version:
+            raise ConflictError('node {} has version {}, not {}'.format(entry['id'], self.version(entry), version))
+        with self.batch():
+            self.data.update(entry)
+            self.set_other_side_of_references(old_entry, entry)
+
+    def version(self, entry_or_id):
+        '''number of changes of the node which update compares to detect changes made meanwhile'''
+        return self.data.version(self.get_id(entry_or_id))
 
     def remove(self, entry_or_id):
         '''remove and existing entry'''
         rem_id = self.get_id(entry_or_id)
         rem_node = self.get(rem_id)
-        self.set_other_side_of_references(rem_node, {})
-        self.data.remove(rem_id)
+        with self.batch():
+            self.set_other_side_of_references(rem_node, {})
+            referrers = self.data.other_referrers(rem_id)
+            if referrers:
+                raise NosError('node {} cannot be removed as it is referenced by {}'.format(rem_id, referrers))
+            self.data.remove(rem_id)
+
+    def referrers(self, entry_or_id, attr=None):
+        '''returns all nodes which reference the given node, optionally only via the given attribute'''
+        node_id = self.get_id(entry_or_id)
+        attr_id = None if attr is None else self._attr_id(attr)
+        return self.find(ids=self.data.referrers(node_id, attr_id))
+
+    #== Traversal ==============================================================
+    # edges are the references between nodes, direction is either "out", "in", or "both"
+
+    def neighbours(self, entry_or_id, attr=None, direction='out'):
+        '''ids of nodes which the node references, which reference it, or both, optionally only via the given attribute'''
+        return self._neighbours(attr, direction)(self.get_id(entry_or_id))
+
+    def traverse(self, start, attr=None, direction='out', depth=None, order='bfs'):
+        '''yields pairs of id and distance of nodes reachable from the start, in breadth-first or depth-first order'''
+        walks = {'bfs': traversal.bfs, 'dfs': traversal.dfs}
+        if order not in walks:
+            raise NosError('unknown traversal order {}, use either "bfs" or "dfs"'.format(order))
+        return walks[order](self.get_id(start), self._neighbours(attr, direction), depth)
+
+    def k_hop(self, start, k, attr=None, direction='out'):
+        '''ids of nodes at most k edges away from the start, excluding it'''
+        return [x for (x, distance) in self.traverse(start, attr, direction, k) if distance > 0]
+
+    def reachable(self, start, target, attr=None, direction='out'):
+        '''whether the target can be reached from the start'''
+        target_id = self.get_id(target)
+        return any(x == target_id for (x, _) in self.traverse(start, attr, direction))
+
+    def shortest_path(self, start, target, attr=None, direction='out'):
+        '''ids of nodes on a shortest path from the start to the target including both, None if there is none'''
+        return traversal.shortest_path(self.get_id(start), self.get_id(target), self._neighbours(attr, direction))
+
+    def _neighbours(self, attr, direction):
+        attr_id = None if attr is None else self._attr_id(attr)
+        if direction == 'out':
+            return lambda x: self.data.references(x, attr_id)
+        if direction == 'in':
+            return lambda x: self.data.referrers(x, attr_id)
+        if direction == 'both':
+            return lambda x: sorted(set(self.data.references(x, attr_id)).union(self.data.referrers(x, attr_id)), key=str)
+        raise NosError('unknown direction {}, use one of "out", "in", or "both"'.format(direction))
+
+    #== Changes ================================================================
+    # changes are numbered in the order they were committed, see noosphere.feed
+
+    def changes(self, after=None, predicate=None, timeout=None):
+        '''changes committed after the sequence number, by default only new ones; waits up to timeout seconds if there are none'''
+        if after is None:
+            after = self.feed.last
+        if timeout is not None:
+            self.feed.wait(after, timeout)
+        return self.feed.since(after, predicate)
+
+    def last_change(self):
+        '''sequence number of the latest change'''
+        return self.feed.last
+
+    def subscribe(self, callback, predicate=None, after=None):
+        '''calls the callback with each committed change of nodes which satisfy the predicate, see ChangeFeed.subscribe'''
+        return self.feed.subscribe(callback, predicate, after)
 
     def clear(self):
         '''remove all entities and start with a clear graph'''
         self.data.clear()
-        self.init_loader()
+        with self.batch():
+            self.init_loader()
+
+    #== Batches ================================================================
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''persist all changes made within the block at once, discard them on an exception'''
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def begin(self):
+        '''start a batch of changes which are persisted on commit'''
+        self.data.begin()
+
+    def commit(self):
+        '''persist the changes of the batch, ConflictError is raised if another process changed the same nodes'''
+        try:
+            self.data.commit()
+        except ConflictError:
+            self.feed.discard()
+            self._run_loaders() # the data were reloaded
+            raise
+        if self.data.batch_depth == 0:
+            self.feed.flush()
+
+    def rollback(self):
+        '''discard the changes of the innermost batch, the outer ones continue'''
+        self.data.rollback()
+        if self.data.batch_depth == 0:
+            self.feed.discard()
+        self._run_loaders()
+
+
+# methods which the plugins add to the graph, they are bound here as their modules import this one
+from noosphere.plugins import integrity, link
+
+Graph.valid_entry = integrity.valid_entry
+Graph.validate_many = integrity.validate_many
+Graph.attribute_validator = integrity.attribute_validator
+Graph.valid_attribute = integrity.valid_attribute
+Graph.set_other_side_of_references = link.set_other_side_of_references
+Graph._relation_attributes_iterator = link._relation_attributes_iterator
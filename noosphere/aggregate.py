@@ -0,0 +1,128 @@
+'''
+Aggregation of attribute values over the nodes of a graph, see Graph.aggregate.
+
+Aggregates are given as a mapping of result names to pairs of a function and an attribute.
+Functions are count, sum, min, max, and avg; count with no attribute counts the nodes themselves.
+Values of arrays are aggregated element by element, references by their ids, and missing values are skipped.
+Nodes are grouped by each distinct value of the grouping attribute, nodes without it form the group None.
+'''
+
+from collections.abc import Mapping
+
+from noosphere import NosError
+from noosphere.index import value_key
+
+FUNCTIONS = ('count', 'sum', 'min', 'max', 'avg')
+
+
+class Accumulator:
+    '''
+    Running value of a single aggregate.
+    '''
+
+    def __init__(self, function):
+        self.function = function
+        self.count = 0
+        self.value = None
+
+    def add(self, value):
+        self.count += 1
+        if self.function == 'count':
+            return
+        if self.value is None:
+            self.value = value
+        elif self.function in ('sum', 'avg'):
+            self.value += value
+        elif self.function == 'min':
+            self.value = min(self.value, value)
+        elif self.function == 'max':
+            self.value = max(self.value, value)
+
+    def result(self):
+        if self.function == 'count':
+            return self.count
+        if self.function == 'sum':
+            return 0 if self.value is None else self.value
+        if self.function == 'avg':
+            return None if self.count == 0 else self.value / self.count
+        return self.value
+
+
+class Aggregation:
+    '''
+    Aggregates of nodes, optionally grouped by values of an attribute.
+    '''
+
+    def __init__(self, aggregates, group_by=None):
+        for (name, (function, attr_id)) in aggregates.items():
+            if function not in FUNCTIONS:
+                raise NosError('unknown aggregate function {} of {}, use one of {}'.format(function, name, FUNCTIONS))
+            if attr_id is None and function != 'count':
+                raise NosError('aggregate {} needs an attribute'.format(name))
+        self.aggregates = aggregates
+        self.group_by = group_by
+        self.groups = {} # key of the group value -> (group value, accumulators by names)
+
+    def add(self, node):
+        if self.group_by is None:
+            self._add(self._group(None, None), node)
+            return
+        if self.group_by not in node:
+            self._add(self._group(None, None), node)
+            return
+        for (key, value) in {value_key(x): x for x in _values(node[self.group_by])}.items():
+            self._add(self._group(key, value), node)
+
+    def _group(self, key, value):
+        if key not in self.groups:
+            self.groups[key] = (value, {x: Accumulator(f) for (x, (f, _)) in self.aggregates.items()})
+        return self.groups[key][1]
+
+    def _add(self, accumulators, node):
+        try:
+            for (name, (_, attr_id)) in self.aggregates.items():
+                if attr_id is None:
+                    accumulators[name].add(1)
+                    continue
+                for value in _values(node.get(attr_id)):
+                    accumulators[name].add(value)
+        except TypeError as e:
+            raise NosError('values of aggregate {} cannot be combined: {}'.format(name, e))
+
+    def add_counts(self, counts, missing):
+        '''
+        Counts nodes given the number of them for each key of the group values, as answered by an index,
+        and the number of nodes without the grouping attribute.
+        '''
+        for (key, count) in counts.items():
+            for accumulator in self._group(key, key[1]).values():
+                accumulator.count += count
+        if missing > 0:
+            for accumulator in self._group(None, None).values():
+                accumulator.count += missing
+
+    def results(self):
+        '''results by names; if grouped, list of them with the group value under "group" ordered by the values'''
+        if self.group_by is None:
+            accumulators = self._group(None, None)
+            return {x: y.result() for (x, y) in accumulators.items()}
+        res = []
+        for key in sorted(self.groups, key=lambda x: (x is None, x)):
+            (value, accumulators) = self.groups[key]
+            row = {'group': value}
+            row.update((x, y.result()) for (x, y) in accumulators.items())
+            res.append(row)
+        return res
+
+
+def _values(value):
+    # values to aggregate, elements of arrays one by one and references by their ids
+    if value is None:
+        return
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _values(item)
+    elif isinstance(value, Mapping) and 'id' in value:
+        yield value['id']
+    else:
+        yield value
@@ -0,0 +1,203 @@
+'''
+Compact binary serialization of the database snapshots.
+
+Every string, attribute id, and referenced id is stored once in a string table and values point to it by its index.
+Keys of a mapping are stored once per distinct set of keys, a shape, so mappings point only to their shape.
+Values are tagged with their type so that integers, decimals, booleans, and references round-trip exactly as with json.
+Tags, indexes, integers, and decimals are kept in separate arrays of fixed-size items, so each array is unpacked at once.
+
+Layout: magic, sizes of the parts (uint32), then the parts: lengths of the strings in characters (uint32),
+all strings as one utf-8 block, shapes as their sizes followed by indexes of their keys (uint32),
+tags of the values in the order of a depth-first walk (uint8), operands of the tags, i.e., indexes and sizes (uint32),
+integers (int64), and decimals (float64), all little-endian. Integers which do not fit are stored as strings.
+
+Loading is done in Python, so it is somewhat slower than the C parser of json; saving is faster and the files are much smaller.
+'''
+
+import sys
+import json
+import array
+import struct
+
+MAGIC = b'NOS\x02'
+
+_NONE, _FALSE, _TRUE, _INT, _BIG_INT, _FLOAT, _STR, _REF, _LIST, _MAP = range(10)
+
+_header = struct.Struct('<7I')
+_INT_RANGE = range(-2**63, 2**63)
+
+
+def dumps(value):
+    '''Serialize a json-compatible value into bytes.'''
+    strings = {}
+    shapes = {}
+    tags = bytearray()
+    operands = array.array('I')
+    integers = array.array('q')
+    decimals = array.array('d')
+
+    def string(text):
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(strings)
+        return index
+
+    def encode(value):
+        if value is None:
+            tags.append(_NONE)
+        elif value is True:
+            tags.append(_TRUE)
+        elif value is False:
+            tags.append(_FALSE)
+        elif isinstance(value, str):
+            tags.append(_STR)
+            operands.append(string(value))
+        elif isinstance(value, int):
+            if value in _INT_RANGE:
+                tags.append(_INT)
+                integers.append(value)
+            else:
+                tags.append(_BIG_INT)
+                operands.append(string(str(value)))
+        elif isinstance(value, float):
+            tags.append(_FLOAT)
+            decimals.append(value)
+        elif isinstance(value, (list, tuple)):
+            tags.append(_LIST)
+            operands.append(len(value))
+            for item in value:
+                encode(item)
+        elif isinstance(value, dict):
+            if len(value) == 1 and isinstance(value.get('id'), str):
+                tags.append(_REF)
+                operands.append(string(value['id']))
+                return
+            for key in value:
+                if not isinstance(key, str):
+                    raise ValueError('keys have to be strings, got {}'.format(key))
+            shape = tuple(map(string, value))
+            index = shapes.get(shape)
+            if index is None:
+                index = shapes[shape] = len(shapes)
+            tags.append(_MAP)
+            operands.append(index)
+            for item in value.values():
+                encode(item)
+        else:
+            raise ValueError('unsupported value {}'.format(value))
+
+    encode(value)
+    block = ''.join(strings).encode('UTF-8', 'surrogatepass')
+    lengths = array.array('I', map(len, strings))
+    shape_items = array.array('I')
+    for shape in shapes:
+        shape_items.append(len(shape))
+        shape_items.extend(shape)
+    arrays = [lengths, shape_items, operands, integers, decimals]
+    if sys.byteorder == 'big':
+        for items in arrays:
+            items.byteswap()
+    header = _header.pack(len(strings), len(block), len(shape_items), len(tags), len(operands), len(integers), len(decimals))
+    return b''.join([MAGIC, header, lengths.tobytes(), block, shape_items.tobytes(), tags,
+                     operands.tobytes(), integers.tobytes(), decimals.tobytes()])
+
+
+def loads(data):
+    '''Deserialize bytes created by dumps.'''
+    data = memoryview(data)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a noosphere binary snapshot')
+    pos = len(MAGIC)
+    try:
+        sizes = _header.unpack_from(data, pos)
+    except struct.error:
+        raise ValueError('truncated binary snapshot')
+    (string_count, block_size, shape_size, tag_count, operand_count, integer_count, decimal_count) = sizes
+    pos += _header.size
+    if len(data) != pos + 4*(string_count + shape_size + operand_count) + block_size + tag_count + 8*(integer_count + decimal_count):
+        raise ValueError('truncated binary snapshot')
+
+    def unpack(typecode, count):
+        nonlocal pos
+        res = array.array(typecode)
+        res.frombytes(data[pos:pos + count*res.itemsize])
+        if sys.byteorder == 'big':
+            res.byteswap()
+        pos += count*res.itemsize
+        return res
+
+    lengths = unpack('I', string_count)
+    # strings are decoded at once and sliced by their lengths in characters
+    text = str(data[pos:pos+block_size], 'UTF-8', 'surrogatepass')
+    pos += block_size
+    strings = []
+    start = 0
+    for length in lengths:
+        strings.append(text[start:start+length])
+        start += length
+    shape_items = unpack('I', shape_size)
+    shapes = []
+    start = 0
+    while start < len(shape_items):
+        end = start + 1 + shape_items[start]
+        shapes.append([strings[x] for x in shape_items[start+1:end]])
+        start = end
+    tags = data[pos:pos+tag_count]
+    pos += tag_count
+    # values are taken from iterators over the arrays, so no positions are tracked
+    tag = iter(tags).__next__
+    operand = iter(unpack('I', operand_count)).__next__
+    integer = iter(unpack('q', integer_count)).__next__
+    decimal = iter(unpack('d', decimal_count)).__next__
+
+    def decode(kind):
+        # ordered by how common the tags are within nodes
+        if kind == _STR:
+            return strings[operand()]
+        if kind == _REF:
+            return {'id': strings[operand()]}
+        if kind == _MAP:
+            keys = shapes[operand()]
+            return dict(zip(keys, [decode(tag()) for _ in keys]))
+        if kind == _INT:
+            return integer()
+        if kind == _LIST:
+            return [decode(tag()) for _ in range(operand())]
+        if kind == _FLOAT:
+            return decimal()
+        if kind == _NONE:
+            return None
+        if kind == _TRUE:
+            return True
+        if kind == _FALSE:
+            return False
+        if kind == _BIG_INT:
+            return int(strings[operand()])
+        raise ValueError('unknown tag {}'.format(kind))
+
+    try:
+        return decode(tag())
+    except (IndexError, StopIteration):
+        raise ValueError('corrupted binary snapshot')
+
+
+def dump(value, file):
+    file.write(dumps(value))
+
+def load(file):
+    return loads(file.read())
+
+
+def export_json(location, json_location):
+    '''Convert a binary snapshot into the json format of FileDB.'''
+    with open(location, 'rb') as file:
+        res = load(file)
+    with open(json_location, 'w', encoding='UTF-8') as file:
+        json.dump(res, file, indent=4)
+
+def import_json(json_location, location):
+    '''Convert a json snapshot of FileDB into the binary format.'''
+    with open(json_location, 'r', encoding='UTF-8') as file:
+        res = json.load(file)
+    with open(location, 'wb') as file:
+        dump(res, file)
@@ -0,0 +1,203 @@
+'''
+Bulk import and export of large datasets.
+
+Entries are read incrementally either from a json array or from newline-delimited json objects.
+An entry may carry an "id" which serves only as its label within the imported data,
+references to labels are replaced by the ids assigned to the entries once all of them are inserted,
+other references have to point to existing nodes.
+The whole import is a single batch of the graph, so the result is written once and nothing of a failed import is left.
+Entries are validated and inserted batch by batch, so the parsed input is not held in memory at once.
+
+Export writes nodes one by one from a snapshot of the database, so neither the whole graph is copied
+nor are the writers blocked while the export runs.
+'''
+
+import json
+import textwrap
+from collections.abc import Mapping
+
+from noosphere import NosError
+from noosphere.data import NodeView
+from noosphere.query import Eq
+from noosphere.index import node_references
+
+READ_SIZE = 1 << 16 # characters read from the input at once
+BATCH_SIZE = 1000 # entries validated and committed at once
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = ' \t\n\r,'
+
+
+def read_entries(file, read_size=READ_SIZE):
+    '''Yields entries of a json array or of newline-delimited json objects without reading the whole file.'''
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in _SEPARATORS:
+            pos += 1
+        if pos < len(buffer) and not started:
+            started = True
+            if buffer[pos] == '[':
+                pos += 1
+                continue
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer):
+            try:
+                (entry, end) = _decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise NosError('invalid json at character {} of the input'.format(pos))
+            else:
+                if not isinstance(entry, dict):
+                    raise NosError('imported entries have to be objects, got {}'.format(entry))
+                yield entry
+                pos = end
+                continue
+        elif eof:
+            return
+        # the entry is incomplete, more of the input is read
+        chunk = file.read(read_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def import_entries(graph, entries, batch_size=BATCH_SIZE):
+    '''
+    Inserts the entries into the graph and returns mapping of their labels to the assigned ids.
+    Entries are validated and inserted in batches, references and two-sided links are resolved
+    once all entries are inserted. All changes are persisted at once, or rolled back if any step fails.
+    '''
+    labels = {}
+    referencing = [] # ids of inserted nodes which contain references
+    with graph.batch():
+        for batch in _chunks(entries, batch_size):
+            _insert(graph, batch, labels, referencing)
+        _resolve(graph, labels, referencing)
+        _link(graph, referencing)
+    return labels
+
+
+def import_file(graph, location, batch_size=BATCH_SIZE):
+    '''imports the json or newline-delimited json file, see import_entries'''
+    with open(location, "r", encoding='UTF-8') as file:
+        return import_entries(graph, read_entries(file), batch_size)
+
+
+def export_nodes(graph, file, predicate=None, node_type=None, ndjson=False):
+    '''
+    Writes nodes which satisfy the predicate and belong to the type, if given, into the file and returns their number.
+    The output is either an indented json array or newline-delimited json.
+    '''
+    if node_type is not None:
+        type_feat = graph.module('type', True)
+        of_type = Eq(type_feat.get('type'), {'id': graph.get_id(node_type)})
+        predicate = of_type if predicate is None else of_type & predicate
+    count = 0
+    with graph.data.snapshot() as snapshot:
+        if not ndjson:
+            file.write('[')
+        for key in snapshot:
+            node = snapshot[key]
+            if predicate is not None and not predicate(NodeView(node)):
+                continue
+            if ndjson:
+                file.write(json.dumps(node) + '\n')
+            else:
+                file.write((',\n' if count else '\n') + textwrap.indent(json.dumps(node, indent=4), '    '))
+            count += 1
+        if not ndjson:
+            file.write('\n]\n')
+    return count
+
+
+def export_file(graph, location, predicate=None, node_type=None):
+    '''exports into the file, as newline-delimited json if its extension is .ndjson or .jsonl, see export_nodes'''
+    ndjson = location.endswith(('.ndjson', '.jsonl'))
+    with open(location, "w", encoding='UTF-8') as file:
+        return export_nodes(graph, file, predicate, node_type, ndjson)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(graph, batch, labels, referencing):
+    graph.validate_many([{k: v for (k, v) in x.items() if k != 'id'} for x in batch])
+    batch_labels = [x.pop('id', None) for x in batch]
+    seen = set()
+    for label in batch_labels:
+        if label is not None and (label in labels or label in seen):
+            raise NosError('label {} is used by more than one imported entry'.format(label))
+        seen.add(label)
+    # ids of the whole batch are allocated at once
+    graph.data.insert_many(batch)
+    for (entry, label) in zip(batch, batch_labels):
+        if label is not None:
+            labels[label] = entry['id']
+        if any(True for _ in node_references(entry)):
+            referencing.append(entry['id'])
+
+
+def _resolve(graph, labels, referencing):
+    # replaces references to labels by the assigned ids, other references have to point to existing nodes
+    for node_id in referencing:
+        for (_, target_id) in node_references(graph.data.view(node_id)):
+            if target_id not in labels and not graph.data.contains(target_id):
+                raise NosError('reference to {} which is neither a label of an imported entry nor a node'.format(target_id))
+        node = graph.data.view(node_id).copy() # the stored node is never altered, even if the database is trusted
+        changed = False
+        for (attr_id, value) in node.items():
+            if isinstance(value, list):
+                if any(_is_label_ref(x, labels) for x in value):
+                    node[attr_id] = [_resolved(x, labels) for x in value]
+                    changed = True
+            elif _is_label_ref(value, labels):
+                node[attr_id] = _resolved(value, labels)
+                changed = True
+        if changed:
+            graph.data.update(node)
+
+
+def _is_label_ref(value, labels):
+    return isinstance(value, Mapping) and len(value) == 1 and value.get('id') in labels
+
+def _resolved(value, labels):
+    if _is_label_ref(value, labels):
+        return {'id': labels[value['id']]}
+    return value
+
+
+def _link(graph, node_ids):
+    # other sides of links are gathered first so that each referenced node is written only once
+    if not graph.module('attribute_id') or not graph.module('link'):
+        return
+    others = {} # referenced id -> list of (attribute id, reference to set)
+    for node in map(graph.view, node_ids):
+        for attr_id in graph._relation_attributes_iterator(node):
+            attr = graph.attribute(attr_id)
+            if not attr.target or node[attr_id] is None:
+                continue
+            values = node[attr_id] if attr.array else [node[attr_id]]
+            for value in filter(None, values):
+                others.setdefault(value['id'], []).append((attr.target, {'id': node['id']}))
+    for (other_id, changes) in others.items():
+        other = graph.view(other_id).copy()
+        for (other_attr_id, entry_ref) in changes:
+            if graph.attribute(other_attr_id).array:
+                refs = other.setdefault(other_attr_id, [])
+                if entry_ref not in refs:
+                    refs.append(entry_ref)
+            else:
+                other[other_attr_id] = entry_ref
+        graph.data.update(other)
@@ -0,0 +1,265 @@
+'''
+Columnar mirror of typed scalar attributes for vectorized filtering and aggregation.
+
+Values of each attribute whose dbtype is int, float, or bool are kept in a NumPy array together with a mask of valid values
+and a mask of the nodes which have the attribute, whatever its value.
+All columns share rows, each node which has any of the attributes is assigned a row.
+The mirror listens to the changes of the database and it is rebuilt lazily once the whole database is replaced.
+Values which do not fit the column, e.g., of a different type, are remembered so that queries stay exact.
+
+NumPy is an optional dependency which is needed only by this module.
+'''
+
+from noosphere import NosError
+from noosphere.index import value_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_DTYPES = {'int': 'int64', 'float': 'float64', 'bool': 'bool'}
+_KINDS = {'int': (int,), 'float': (int, float), 'bool': (bool,)}
+_INITIAL_ROWS = 64
+
+
+class Column:
+    '''
+    Values of a single attribute aligned to the rows of the store.
+    '''
+
+    def __init__(self, attr_id, dbtype, rows):
+        self.attr_id = attr_id
+        self.dbtype = dbtype
+        self.values = numpy.zeros(rows, dtype=_DTYPES[dbtype])
+        self.valid = numpy.zeros(rows, dtype=bool)
+        self.present = numpy.zeros(rows, dtype=bool)
+        self.irregular = set() # keys of nodes whose value does not fit into the column
+        self.kind = value_key(False if dbtype == 'bool' else 0)[0] # kind of the values as distinguished by indexes
+
+    def grow(self, rows):
+        size = len(self.valid)
+        self.values = numpy.resize(self.values, rows)
+        self.valid = numpy.resize(self.valid, rows)
+        self.valid[size:] = False
+        self.present = numpy.resize(self.present, rows)
+        self.present[size:] = False
+
+    def set(self, row, key, node):
+        self.irregular.discard(key)
+        self.valid[row] = False
+        self.present[row] = node is not None and self.attr_id in node
+        if not self.present[row]:
+            return
+        value = node[self.attr_id]
+        if value is None:
+            return
+        if not isinstance(value, _KINDS[self.dbtype]) or (isinstance(value, bool) and self.dbtype != 'bool'):
+            self.irregular.add(key)
+            return
+        try:
+            self.values[row] = value
+        except OverflowError:
+            self.irregular.add(key)
+            return
+        self.valid[row] = True
+
+
+class ColumnStore:
+    '''
+    Columns of the given attributes of the graph; by default of all attributes typed as int, float, or bool.
+    Columns also serve as indexes of the database, so Eq and Range predicates are answered from them.
+    Indexes which the database had over the attributes are only set aside and they are kept up to date,
+    so they are in place again once the store is closed and readers of snapshots keep using them.
+    '''
+
+    def __init__(self, graph, attrs=None):
+        if numpy is None:
+            raise NosError('columnar store requires numpy which is not installed')
+        self.graph = graph
+        self.data = graph.data
+        if attrs is None:
+            attrs = self._typed_attributes()
+        self.columns = {}
+        for attr in attrs:
+            attr_id = graph._attr_id(attr)
+            attribute = graph.attribute(attr_id)
+            if attribute.dbtype not in _DTYPES or attribute.array:
+                raise NosError('attribute {} is not a scalar of type int, float, or bool'.format(attr_id))
+            self.columns[attr_id] = attribute.dbtype
+        self.built = False
+        self.data.listeners.append(self)
+        self.replaced = {} # attribute id -> index of the database which the column stands in for
+        for attr_id in self.columns:
+            self.replaced[attr_id] = self.data.indexes.get(attr_id)
+            index = ColumnIndex(self, attr_id, self.replaced[attr_id])
+            self.data.indexes[attr_id] = index
+            self.data.listeners.append(index)
+
+    def _typed_attributes(self):
+        attr_feat = self.graph.module('attribute_id', True)
+        dbtype_id = attr_feat.get('dbtype')
+        array_id = attr_feat.get('array')
+        return [x['id'] for x in self.data.views() if x.get(dbtype_id) in _DTYPES and not x.get(array_id)]
+
+    def close(self):
+        '''stop mirroring the database'''
+        self.data.listeners.remove(self)
+        for (attr_id, index) in self.replaced.items():
+            if not isinstance(self.data.indexes.get(attr_id), ColumnIndex):
+                continue # the index was replaced meanwhile
+            self.data.listeners.remove(self.data.indexes[attr_id])
+            if index is None:
+                del self.data.indexes[attr_id]
+            else:
+                self.data.indexes[attr_id] = index
+
+    #== Synchronization ========================================================
+
+    def changed(self, node_id, old_node, new_node):
+        if not self.built:
+            return
+        key = str(node_id)
+        row = self.rows.get(key)
+        if new_node is None or not any(x in new_node for x in self.columns):
+            if row is not None:
+                self._free(row, key)
+            return
+        if row is None:
+            row = self._allocate(key)
+        for column in self.by_attr.values():
+            column.set(row, key, new_node)
+
+    def reset(self):
+        self.built = False
+
+    def _build(self):
+        if self.built:
+            return
+        self.rows = {} # node key -> row
+        self.keys = numpy.empty(_INITIAL_ROWS, dtype=object) # row -> node key, None if the row is free
+        self.free = []
+        self.by_attr = {x: Column(x, dbtype, _INITIAL_ROWS) for (x, dbtype) in self.columns.items()}
+        self.built = True
+        for view in self.data.views():
+            self.changed(view['id'], None, view)
+
+    def _allocate(self, key):
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = len(self.rows)
+            if row >= len(self.keys):
+                size = 2 * len(self.keys)
+                self.keys = numpy.resize(self.keys, size)
+                self.keys[row:] = None
+                for column in self.by_attr.values():
+                    column.grow(size)
+        self.rows[key] = row
+        self.keys[row] = key
+        return row
+
+    def _free(self, row, key):
+        del self.rows[key]
+        self.keys[row] = None
+        for column in self.by_attr.values():
+            column.set(row, key, None)
+        self.free.append(row)
+
+    #== Filtering ==============================================================
+
+    def column(self, attr):
+        '''column of the attribute, see Column'''
+        self._build()
+        attr_id = self.graph._attr_id(attr)
+        if attr_id not in self.by_attr:
+            raise NosError('attribute {} is not kept in the columnar store'.format(attr_id))
+        return self.by_attr[attr_id]
+
+    def mask(self, attr, low=None, high=None):
+        '''rows whose value lies between low and high including both, a missing bound is unlimited'''
+        column = self.column(attr)
+        res = column.valid.copy()
+        if low is not None:
+            res &= column.values >= low
+        if high is not None:
+            res &= column.values <= high
+        return res
+
+    def equal_mask(self, attr, value):
+        '''rows whose value equals to the given one'''
+        column = self.column(attr)
+        return column.valid & (column.values == value)
+
+    def ids(self, mask):
+        '''ids of nodes in the rows of the mask ordered by the ids'''
+        return sorted(self.keys[numpy.flatnonzero(mask)])
+
+    #== Aggregation ============================================================
+    # values of irregular nodes are not part of the aggregates
+
+    def _selected(self, attr, mask):
+        column = self.column(attr)
+        selected = column.valid if mask is None else column.valid & mask
+        return column.values[selected]
+
+    def count(self, attr, mask=None):
+        return len(self._selected(attr, mask))
+
+    def sum(self, attr, mask=None):
+        return self._selected(attr, mask).sum().item()
+
+    def min(self, attr, mask=None):
+        values = self._selected(attr, mask)
+        return values.min().item() if len(values) else None
+
+    def max(self, attr, mask=None):
+        values = self._selected(attr, mask)
+        return values.max().item() if len(values) else None
+
+    def mean(self, attr, mask=None):
+        values = self._selected(attr, mask)
+        return values.mean().item() if len(values) else None
+
+    def histogram(self, attr, bins=10, mask=None):
+        '''counts of values within equally wide bins and the edges of the bins'''
+        (counts, edges) = numpy.histogram(self._selected(attr, mask), bins=bins)
+        return (counts.tolist(), edges.tolist())
+
+
+class ColumnIndex:
+    '''
+    Index over a column of the store, the store keeps it up to date.
+    Its kind is that of the replaced index, as snapshots of the database get that one.
+    '''
+
+    def __init__(self, store, attr_id, replaced=None):
+        self.store = store
+        self.attr_id = attr_id
+        self.kind = None if replaced is None else replaced.kind
+
+    def changed(self, node_id, old_node, new_node):
+        pass
+
+    def reset(self):
+        pass
+
+    def _with_irregular(self, mask):
+        return set(self.store.ids(mask)) | self.store.by_attr[self.attr_id].irregular
+
+    def having(self):
+        return set(self.store.ids(self.store.column(self.attr_id).present))
+
+    def equal(self, value):
+        column = self.store.column(self.attr_id)
+        key = value_key(value)
+        if key is None or key[0] != column.kind:
+            return set(column.irregular)
+        return self._with_irregular(self.store.equal_mask(self.attr_id, value))
+
+    def between(self, low, high):
+        column = self.store.column(self.attr_id)
+        bound = low if low is not None else high
+        if bound is not None and value_key(bound)[0] != column.kind:
+            return set(column.irregular)
+        return self._with_irregular(self.store.mask(self.attr_id, low, high))
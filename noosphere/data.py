@@ -3,21 +3,452 @@ Various ways to save the data.
 '''
 
 import os
+import sys
 import json
 import copy
+import math
+import types
+import bisect
+import mmap
+import sqlite3
+import zlib
+import contextlib
+import threading
+from collections.abc import Mapping
 
+try:
+    import fcntl
+except ImportError: # not available on windows, processes are not synchronized there
+    fcntl = None
+
+from noosphere import NosError, ConflictError, binary
 from noosphere.identifier import AlphaNumId
+from noosphere.index import HashIndex, SortedIndex, RefIndex, overlay, value_key, value_keys, node_references
+
+
+class FrozenList(tuple):
+    '''
+    Read-only list used within node views, it equals to a list with the same items.
+    '''
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            other = tuple(other)
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+
+class NodeView(Mapping):
+    '''
+    Read-only view of a stored node which avoids copying it.
+    Use copy() to obtain a node which may be altered.
+    '''
+
+    __slots__ = ('_node',)
+
+    def __init__(self, node):
+        self._node = node
+
+    def __getitem__(self, key):
+        return _freeze(self._node[key])
+
+    def __contains__(self, key):
+        return key in self._node
+
+    def __iter__(self):
+        return iter(self._node)
+
+    def __len__(self):
+        return len(self._node)
+
+    def __eq__(self, other):
+        if isinstance(other, NodeView):
+            other = other._node
+        return self._node == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'NodeView({})'.format(self._node)
+
+    def copy(self):
+        return copy_node(self._node)
+
+
+_LISTS = (list, tuple)
+_MAPPINGS = (dict, types.MappingProxyType, NodeView)
+_NESTED = _LISTS + _MAPPINGS
+
+def _freeze(value):
+    if isinstance(value, _LISTS):
+        return FrozenList(_freeze(x) for x in value)
+    if isinstance(value, _MAPPINGS):
+        return types.MappingProxyType({k: _freeze(v) for (k, v) in value.items()})
+    return value
+
+def _copy_value(value):
+    if isinstance(value, _LISTS):
+        return [_copy_value(x) if isinstance(x, _NESTED) else x for x in value]
+    return {k: _copy_value(v) if isinstance(v, _NESTED) else v for (k, v) in value.items()}
+
+def copy_value(value):
+    '''Copy of a value with read-only views of nodes, their arrays and objects turned into plain dicts and lists.'''
+    if isinstance(value, _NESTED):
+        return _copy_value(value)
+    return value
+
+def copy_node(node):
+    '''Copy of a node, as nodes are flat it is considerably faster than a deepcopy.'''
+    res = {}
+    for (key, value) in node.items():
+        if isinstance(value, _NESTED):
+            value = _copy_value(value)
+        res[key] = value
+    return res
+
+class Overlay(Mapping):
+    '''
+    Nodes of a base mapping with layers of later changes over it, the newest last; None marks a removed node.
+    Adjacent layers are merged once the newer one is at least half as large, so there are only logarithmically many of them
+    and each change is copied only a few times. Layers are merged into a dict base once they are at least half as large as it.
+    '''
+
+    def __init__(self, base, layers=()):
+        self.base = base
+        self.layers = layers
+        self.size = sum(map(len, layers)) # number of changes within the layers, including repeated ones
+
+    def updated(self, changes):
+        '''overlay with another layer of changes, this one is not altered'''
+        layers = self.layers + (dict(changes),)
+        while len(layers) > 1 and len(layers[-2]) <= 2 * len(layers[-1]):
+            merged = dict(layers[-2])
+            merged.update(layers[-1])
+            layers = layers[:-2] + (merged,)
+        base = self.base
+        if isinstance(base, dict) and len(base) <= 2 * len(layers[0]):
+            base = dict(base)
+            for (key, node) in layers[0].items():
+                if node is None:
+                    base.pop(key, None)
+                else:
+                    base[key] = node
+            layers = layers[1:]
+        return Overlay(base, layers)
+
+    def __getitem__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                if layer[key] is None:
+                    raise KeyError(key)
+                return layer[key]
+        return self.base[key]
+
+    def __contains__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                return layer[key] is not None
+        return key in self.base
+
+    def __iter__(self):
+        changes = {}
+        for layer in self.layers:
+            changes.update(layer)
+        for key in self.base:
+            if key not in changes:
+                yield key
+        for (key, node) in changes.items():
+            if node is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+LAYERED_MAX = 4096 # number of changes laid over a snapshot of data held in files before a new one is taken
+ORDER_MIN = 1024 # number of changed keys the order of an earlier snapshot is reused with in any case
+
+_users_lock = threading.Lock()
+
+class Snapshot(Mapping):
+    '''
+    Stored nodes by their keys as they were when the snapshot was taken, iterated in the order of their keys.
+    Nodes are never altered in place, so keeping references to them suffices; they must not be altered by the reader either.
+    Later snapshots are made by updated() which shares the unchanged nodes, the order, and the resources of this one.
+    '''
+
+    layered = True # whether updated snapshots lay the changes over the nodes, otherwise they are laid over the snapshot
+
+    def __init__(self, nodes, source=None):
+        self.nodes = nodes
+        self.order = None # sorted on the first iteration
+        self.basis = None # sorted keys of an earlier snapshot and the keys changed since, whether they are present
+        self.source = source # snapshot whose resources this one uses
+        self.users = 1 # the snapshot itself and the snapshots which use its resources
+        if source is not None:
+            with _users_lock:
+                source.users += 1
+
+    def __getitem__(self, key):
+        return self.nodes[key]
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __iter__(self):
+        return iter(self._order())
+
+    def __len__(self):
+        return len(self._order())
+
+    def _order(self):
+        order = self.order
+        if order is None:
+            basis = self.basis
+            if basis is None:
+                order = sorted(self.nodes)
+            else:
+                (kept, changed) = basis
+                order = [x for x in kept if x not in changed]
+                order.extend(x for (x, present) in changed.items() if present)
+                order.sort() # the kept keys are sorted already, so it takes linear time
+            self.order = order
+            self.basis = None
+        return order
+
+    def updated(self, nodes):
+        '''snapshot with the given nodes by their keys changed, None marks a removed one; this one is not altered'''
+        if self.layered:
+            layers = self.nodes if isinstance(self.nodes, Overlay) else Overlay(self.nodes)
+            res = type(self)(layers.updated(nodes), self.source)
+        else:
+            res = Snapshot(Overlay(self).updated(nodes), self)
+        (order, basis) = (self.order, self.basis)
+        if order is not None:
+            basis = (order, {})
+        elif basis is not None:
+            basis = (basis[0], dict(basis[1]))
+        if basis is not None:
+            basis[1].update((key, node is not None) for (key, node) in nodes.items())
+            if len(basis[1]) <= max(ORDER_MIN, math.isqrt(len(basis[0]))):
+                res.basis = basis
+        return res
+
+    def overlaid(self):
+        '''number of changes laid over the nodes of the snapshot'''
+        return self.nodes.size if isinstance(self.nodes, Overlay) else 0
+
+    def close(self):
+        with _users_lock:
+            if self.users == 0:
+                return
+            self.users -= 1
+            if self.users > 0:
+                return
+        self._release()
+        if self.source is not None:
+            self.source.close()
+
+    def _release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class IndexedSnapshot(Snapshot):
+    '''
+    Snapshot of IndexedFileDB which decodes nodes on demand from its own mapping of the data file.
+    The data file is only appended to or replaced, so the mapped positions stay valid.
+    '''
+
+    layered = False
+
+    def __init__(self, offsets, dirty, location):
+        super().__init__(dirty)
+        self.offsets = offsets
+        self.mapped = None
+        if offsets:
+            with open(location, "rb") as file:
+                self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getitem__(self, key):
+        if key in self.nodes:
+            if self.nodes[key] is None:
+                raise KeyError(key)
+            return self.nodes[key]
+        (offset, length) = self.offsets[key]
+        return json.loads(self.mapped[offset:offset+length])
+
+    def __contains__(self, key):
+        if key in self.nodes:
+            return self.nodes[key] is not None
+        return key in self.offsets
+
+    def _order(self):
+        if self.order is None:
+            keys = set(self.offsets).union(self.nodes)
+            self.order = sorted(x for x in keys if self.nodes.get(x, True) is not None)
+        return self.order
+
+    def _release(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class ShardedSnapshot(Snapshot):
+    '''
+    Snapshot of ShardedFileDB which shares the loaded shards and reads the others on demand from files opened when it was taken.
+    Shard files are replaced rather than rewritten and the database copies shared shards before changing them.
+    '''
+
+    layered = False
+
+    def __init__(self, data):
+        super().__init__(None)
+        self.root = data.root
+        self.shard_count = data.shard_count
+        self.shards = dict(data.shards)
+        self.files = {} # shard number -> its opened file, for shards which were not loaded
+        for number in range(self.shard_count):
+            if number not in self.shards:
+                try:
+                    self.files[number] = open(data._shard_location(number), "rb")
+                except FileNotFoundError:
+                    self.shards[number] = {}
+        self.lock = threading.Lock()
+
+    def _shard(self, number):
+        shard = self.shards.get(number)
+        if shard is None:
+            with self.lock:
+                shard = self.shards.get(number)
+                if shard is None:
+                    with self.files.pop(number) as file:
+                        shard = self.shards[number] = json.loads(file.read())
+        return shard
+
+    def __getitem__(self, key):
+        if key == '!0':
+            if self.root is None:
+                raise KeyError(key)
+            return self.root
+        return self._shard(_shard_number(key, self.shard_count))[key]
+
+    def __contains__(self, key):
+        if key == '!0':
+            return self.root is not None
+        return key in self._shard(_shard_number(key, self.shard_count))
+
+    def _order(self):
+        if self.order is None:
+            keys = [] if self.root is None else ['!0']
+            for number in range(self.shard_count):
+                keys.extend(self._shard(number))
+            self.order = sorted(keys)
+        return self.order
+
+    def _release(self):
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files = {}
+
+
+class SqliteSnapshot(Snapshot):
+    '''
+    Snapshot of SqliteDB which reads the committed nodes within its own read transaction.
+    '''
+
+    layered = False
+
+    def __init__(self, location):
+        super().__init__(None)
+        self.connection = sqlite3.connect(location, isolation_level=None, check_same_thread=False)
+        self.connection.execute('BEGIN')
+        # the first read fixes the version of the database seen by the transaction
+        self.connection.execute('SELECT 1 FROM nodes LIMIT 1').fetchall()
+
+    def __getitem__(self, key):
+        row = self.connection.execute('SELECT body FROM nodes WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        return self.connection.execute('SELECT 1 FROM nodes WHERE id = ?', (key,)).fetchone() is not None
+
+    def _order(self):
+        if self.order is None:
+            self.order = [x[0] for x in self.connection.execute('SELECT id FROM nodes ORDER BY id')]
+        return self.order
+
+    def _release(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+@contextlib.contextmanager
+def _file_lock(location):
+    # exclusive among processes which lock the same file
+    with open(location, "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _reference_pattern(node_id):
+    # bytes of a reference to the node within compact json, nodes without them need not be decoded
+    return b'{"id":' + json.dumps(node_id).encode('UTF-8') + b'}'
+
+def _other_referrers(nodes, node_id):
+    res = [x['id'] for x in nodes if x['id'] != node_id and any(y == node_id for (_, y) in node_references(x))]
+    return sorted(res, key=str)
+
+def _shard_number(key, count):
+    # shard of ShardedFileDB which holds the node
+    return zlib.crc32(key.encode('UTF-8')) % count
+
+def _stat(location):
+    try:
+        stat = os.stat(location)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 
 class MemoryDB:
     '''
     In-memory database without persistance for testing.
+    Trusted callers promise not to alter given or retrieved nodes, so they are not copied.
     '''
 
-    def __init__(self):
+    versioned = False # whether versions of nodes are persisted, so changes made by others show in them after a load
+
+    def __init__(self, trusted=False):
+        self.trusted = trusted
         self.orig_ids = AlphaNumId(6)
         self.ids = copy.deepcopy(self.orig_ids)
-        self.clear()
+        self.indexes = {}
+        self.refs = RefIndex(self)
+        self.listeners = [self.refs]
+        MemoryDB.clear(self) # subclasses may not be ready to clear their storage yet
 
     def is_id(self, entry_id):
         return self.ids.is_id(entry_id)
@@ -29,28 +460,119 @@ class MemoryDB:
         return entry['id']
 
     def all(self):
-        return [copy.deepcopy(x) for x in self.db.values()]
+        return [self._copy(x) for x in self._nodes()]
 
     def get(self, entry_id):
-        if str(entry_id) not in self.db:
+        node = self._node(str(entry_id))
+        if node is None:
             return None
-        return copy.deepcopy(self.db[str(entry_id)])
+        return self._copy(node)
+
+    def view(self, entry_id):
+        '''read-only view of the node, or None if it does not exist'''
+        node = self._node(str(entry_id))
+        if node is None:
+            return None
+        return NodeView(node)
+
+    def views(self):
+        '''read-only views of all nodes'''
+        return [NodeView(x) for x in self._nodes()]
+
+    def materialize(self, view):
+        '''node of the view which the caller may alter'''
+        return self._copy(view._node)
+
+    def _copy(self, node):
+        if self.trusted:
+            return node
+        return copy_node(node)
+
+    def _own(self, entry):
+        # stored nodes are never altered, so listeners may keep them; the caller keeps the entry
+        if self.trusted:
+            return entry
+        return copy_node(entry)
+
+    def contains(self, entry_id):
+        '''whether a node with the id is stored'''
+        return self._has(str(entry_id))
+
+    def reserve_ids(self, start, size):
+        '''start of a block of size integer ids no one else gets, ids before start are known to be reserved'''
+        return start
 
     def insert(self, entry):
         assert 'id' not in entry
         entry['id'] = self.ids.new_id(self)
-        self.db[str(self.get_id(entry))] = copy.deepcopy(entry)
-        self.save()
+        self._store(entry['id'], self._own(entry))
+        self._written([entry['id']])
+
+    def insert_many(self, entries):
+        '''inserts the entries with ids allocated at once and persists them together'''
+        assert all('id' not in x for x in entries)
+        for (entry, new_id) in zip(entries, self.ids.new_ids(self, len(entries))):
+            entry['id'] = new_id
+            self._store(new_id, self._own(entry))
+        self._written([x['id'] for x in entries])
 
     def update(self, entry):
-        self.db[str(self.get_id(entry))] = copy.deepcopy(entry)
-        self.save()
+        self._store(self.get_id(entry), self._own(entry))
+        self._written([entry['id']])
 
     def remove(self, entry_id):
-        nodes = self.db
-        nodes.pop(str(entry_id))
-        self.db = nodes
-        self.save()
+        self._store(entry_id, None)
+        self._written([entry_id])
+
+    def version(self, entry_id):
+        '''number of changes of the node, 0 if it does not exist'''
+        return self.versions.get(str(entry_id), 0)
+
+    def _store(self, node_id, node, version=None):
+        # every change of the stored nodes goes through here, the version is given only when a node is restored
+        key = str(node_id)
+        old_node = self._node(key)
+        old_version = self.versions.get(key, 0)
+        if self.batch_depth > 0:
+            self.savepoints[-1][1].setdefault(key, (node_id, old_node, old_version))
+        self.unsaved.setdefault(key, old_version) # the version the persisted change is based on
+        self._write(key, node)
+        if node is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = old_version + 1 if version is None else version
+        if (old_node is None) != (node is None):
+            self.order = None
+        for listener in self.listeners:
+            listener.changed(node_id, old_node, node)
+
+    #== Storage =================================================================
+    # databases which do not hold all nodes in the db dictionary override these
+
+    def _node(self, key):
+        return self.db.get(key)
+
+    def _has(self, key):
+        return key in self.db
+
+    def _nodes(self):
+        return self.db.values()
+
+    def _keys(self):
+        return self.db.keys()
+
+    def _write(self, key, node):
+        if node is None:
+            self.db.pop(key, None)
+        else:
+            self.db[key] = node
+
+    def _scan(self, after):
+        # stored nodes ordered by their keys starting after the given one
+        keys = self.keys()
+        start = 0 if after is None else bisect.bisect_right(keys, str(after))
+        for pos in range(start, len(keys)):
+            yield self._node(keys[pos])
 
     def load(self):
         pass
@@ -58,38 +580,1130 @@ class MemoryDB:
     def save(self):
         pass
 
+    def save_nodes(self, node_ids):
+        '''persist changes of the given nodes, by default the whole database is saved'''
+        self.save()
+
+    def stale(self):
+        '''whether the persisted data were changed by someone else since they were loaded'''
+        return False
+
+    #== Batches =================================================================
+
+    def begin(self):
+        '''defer persistence of the following changes until the outermost batch is committed, batches may be nested'''
+        # each batch keeps the ids state and the nodes as they were before it changed them
+        self.savepoints.append((self.ids.save(), {}))
+        self.batch_depth += 1
+
+    def commit(self):
+        '''end the innermost batch, all changes are persisted at once when the outermost one ends'''
+        if self.batch_depth == 0:
+            return
+        (_, nodes) = self.savepoints.pop()
+        self.batch_depth -= 1
+        if self.batch_depth > 0:
+            outer = self.savepoints[-1][1]
+            for (key, saved) in nodes.items():
+                outer.setdefault(key, saved)
+        elif nodes:
+            self._persist([node_id for (node_id, _, _) in nodes.values()])
+
+    def rollback(self):
+        '''discard the changes of the innermost batch, the outer ones continue'''
+        if self.batch_depth == 0:
+            return
+        (ids_state, nodes) = self.savepoints[-1]
+        # nodes are restored within the batch, so listeners see the restoration as its part
+        for (key, (node_id, node, version)) in nodes.items():
+            self._store(node_id, node, version)
+            if self.unsaved.get(key) == version:
+                del self.unsaved[key] # the node is as it was saved
+        self.savepoints.pop()
+        self.batch_depth -= 1
+        self.ids.load(ids_state)
+
+    def _written(self, node_ids):
+        if self.batch_depth == 0:
+            self._persist(node_ids)
+
+    def _persist(self, node_ids):
+        self.save_nodes(node_ids)
+        self.unsaved = {}
+
+    #== Indexes =================================================================
+
+    def add_index(self, attr_id, kind='hash'):
+        '''maintain an index over values of the attribute, kind is either "hash" or "sorted"'''
+        self.remove_index(attr_id)
+        if kind == 'hash':
+            index = HashIndex(self, attr_id)
+        elif kind == 'sorted':
+            index = SortedIndex(self, attr_id)
+        else:
+            raise ValueError('unknown index kind {}'.format(kind))
+        self.indexes[attr_id] = index
+        self.listeners.append(index)
+
+    def remove_index(self, attr_id):
+        index = self.indexes.pop(attr_id, None)
+        if index is not None:
+            self.listeners.remove(index)
+
+    def keys(self):
+        '''keys of all nodes in a stable sorted order'''
+        if self.order is None:
+            self.order = sorted(self._keys())
+        return self.order
+
+    def query(self, predicate, after=None):
+        '''
+        Yields read-only views of nodes which satisfy the predicate ordered by their ids,
+        only nodes after the given id are considered. Indexes are used where possible.
+        '''
+        candidates = None
+        if hasattr(predicate, 'candidates'):
+            candidates = predicate.candidates(self.indexes)
+        if candidates is None:
+            nodes = self._scan(after)
+        else:
+            keys = sorted(str(x) for x in candidates)
+            start = 0 if after is None else bisect.bisect_right(keys, str(after))
+            nodes = map(self._node, keys[start:])
+        for node in nodes:
+            if node is not None and predicate(NodeView(node)):
+                yield NodeView(node)
+
+    def referrers(self, node_id, attr_id=None):
+        '''ids of nodes which reference the given node'''
+        return sorted(self.refs.referrers(node_id, attr_id), key=str)
+
+    def references(self, node_id, attr_id=None):
+        '''ids of nodes which the given node references'''
+        return sorted(self.refs.references(node_id, attr_id), key=str)
+
+    def other_referrers(self, node_id):
+        '''ids of nodes other than the given one which reference it, checked before the node is removed'''
+        return [x for x in self.referrers(node_id) if x != node_id]
+
+    def snapshot(self):
+        '''nodes as they are now which later changes do not affect, see Snapshot'''
+        return Snapshot({key: self._node(key) for key in self._keys()})
+
+    def _updated_snapshot(self, snapshot, keys):
+        # snapshot of the nodes as they are now given an earlier one and the keys of the nodes changed since
+        return snapshot.updated({key: self.db.get(key) for key in keys})
+
+    def reader(self, previous=None, changes=None):
+        '''
+        Read-only database of the nodes as they are now with the same indexes, see SnapshotDB.
+        Given the previous reader and the changes since it was made as by key: (node id, node in the previous reader),
+        the reader shares its unchanged nodes, versions, and built indexes, so it takes time proportional to the changes.
+        '''
+        if previous is None or changes is None:
+            res = SnapshotDB(self.snapshot(), self.ids, Overlay(dict(self.versions)))
+        else:
+            snapshot = self._updated_snapshot(previous.snapshot_nodes, list(changes))
+            versions = previous.versions.updated({key: self.versions.get(key) for key in changes})
+            res = SnapshotDB(snapshot, self.ids, versions)
+        for (attr_id, index) in self.indexes.items():
+            if index.kind is not None:
+                res.add_index(attr_id, index.kind)
+        if previous is not None and changes is not None:
+            res._reuse_indexes(previous, changes)
+        return res
+
+    def _reset(self):
+        # the stored nodes were replaced all at once
+        self.order = None
+        self.unsaved = {}
+        for listener in self.listeners:
+            listener.reset()
+
     def clear(self):
         self.ids = copy.deepcopy(self.orig_ids)
         self.db = {}
+        self.versions = {} # node key -> number of its changes
+        self.batch_depth = 0
+        self.savepoints = [] # ids state and original nodes of each open batch, the innermost last
+        self._reset()
+
+
+class SnapshotDB(MemoryDB):
+    '''
+    Read-only database over a snapshot of another database.
+    Its readers see the nodes as they were when the snapshot was taken whatever is written to the other database meanwhile.
+    Indexes are built on their first use, either anew or from the built indexes of the previous reader, see MemoryDB.reader.
+    Readers share the versions which must not be altered.
+    '''
+
+    def __init__(self, snapshot, ids, versions):
+        super().__init__()
+        self.snapshot_nodes = snapshot
+        self.ids = copy.deepcopy(ids)
+        self.versions = versions
+
+    def close(self):
+        self.snapshot_nodes.close()
+
+    def _reuse_indexes(self, previous, changes):
+        for (attr_id, index) in list(self.indexes.items()):
+            old = previous.indexes.get(attr_id)
+            if old is not None and old.kind == index.kind:
+                self._replace(index, overlay(old, self, changes))
+        self._replace(self.refs, overlay(previous.refs, self, changes))
+
+    def _replace(self, index, reused):
+        if reused is None:
+            return
+        if index is self.refs:
+            self.refs = reused
+        else:
+            self.indexes[index.attr_id] = reused
+        self.listeners[self.listeners.index(index)] = reused
+
+    #== Storage =================================================================
+
+    def _node(self, key):
+        return self.snapshot_nodes.get(key)
+
+    def _has(self, key):
+        return key in self.snapshot_nodes
+
+    def _nodes(self):
+        return (self.snapshot_nodes[x] for x in self.snapshot_nodes)
+
+    def _keys(self):
+        return list(self.snapshot_nodes)
+
+    def _write(self, key, node):
+        raise NosError('the snapshot of the database is read-only')
+
+
+class CompactDB(MemoryDB):
+    '''
+    In-memory database which stores nodes compactly to hold more of them.
+    A node is kept as a tuple of its values preceded by its shape, i.e., the tuple of its attribute ids shared among nodes.
+    References are kept as shared objects of interned ids, arrays as tuples.
+    Nodes are decoded into plain dicts whenever they are read.
+    '''
+
+    def __init__(self, trusted=False):
+        super().__init__(trusted)
+        self.shapes = {}
+        self.ref_objects = {}
+
+    def snapshot(self):
+        return CompactSnapshot(dict(self.db))
+
+    def clear(self):
+        super().clear()
+        self.shapes = {}
+        self.ref_objects = {}
+
+    #== Storage =================================================================
+
+    def _copy(self, node):
+        return node # nodes are encoded when written and decoded anew on each read
+
+    def _node(self, key):
+        packed = self.db.get(key)
+        if packed is None:
+            return None
+        return _decode_node(packed)
+
+    def _nodes(self):
+        return map(_decode_node, self.db.values())
+
+    def _write(self, key, node):
+        if node is None:
+            self.db.pop(key, None)
+            return
+        shape = self.shapes.get(tuple(node))
+        if shape is None:
+            shape = tuple(sys.intern(x) if isinstance(x, str) else x for x in node)
+            self.shapes[shape] = shape
+        self.db[sys.intern(key)] = (shape,) + tuple(map(self._encode, node.values()))
+
+    def _encode(self, value):
+        if isinstance(value, _LISTS):
+            return tuple(map(self._encode, value))
+        if isinstance(value, _MAPPINGS):
+            if len(value) == 1 and isinstance(value.get('id'), str):
+                ref_id = value['id']
+                ref = self.ref_objects.get(ref_id)
+                if ref is None:
+                    ref = self.ref_objects[ref_id] = _Ref(sys.intern(ref_id))
+                return ref
+            return _copy_value(value)
+        return value
+
+
+class _Ref:
+    # reference stored by CompactDB, one for each referenced id
+    __slots__ = ('id',)
+
+    def __init__(self, ref_id):
+        self.id = ref_id
+
+def _decode_node(packed):
+    return dict(zip(packed[0], map(_decode_value, packed[1:])))
+
+def _decode_value(value):
+    if isinstance(value, tuple):
+        return [_decode_value(x) for x in value]
+    if isinstance(value, _Ref):
+        return {'id': value.id}
+    if isinstance(value, dict):
+        return _copy_value(value)
+    return value
+
+
+class CompactSnapshot(Snapshot):
+    '''
+    Snapshot of CompactDB whose nodes are decoded when they are read.
+    '''
+
+    def __getitem__(self, key):
+        return _decode_node(self.nodes[key])
 
 
 class FileDB(MemoryDB):
     '''
     File database without persistance for testing.
+    Several processes may write to the same file. Changes are saved under a lock of the file;
+    when another process saved meanwhile, its nodes are loaded and ours are kept unless both changed the same node.
     '''
 
-    def __init__(self, location):
-        super().__init__()
+    versioned = True
+
+    def __init__(self, location, trusted=False):
+        super().__init__(trusted)
         self.location = os.path.expanduser(location)
+        self.file_stat = None
         self.db = None
         self.load()
 
     def load(self):
         if os.path.exists(self.location):
-            with open(self.location, "r", encoding='UTF-8') as file:
-                res = json.load(file)
-                self.db = res['nodes']
-                self.ids.load(res['ids'])
+            self._load()
+            self._reset()
+            self.file_stat = self._file_stat()
         else:
             self.clear()
             self.save()
 
+    def _load(self):
+        # reads the saved state, listeners are reset by the caller once the state is final
+        res = self._read_snapshot()
+        self.db = res['nodes']
+        self.versions = res.get('versions', {})
+        self.ids.load(res['ids'])
+
     def save(self):
-        res = {'nodes': self.db, 'ids': self.ids.save()}
-        with open(self.location, "w+", encoding='UTF-8') as file:
+        # written aside and moved over the file so that no process reads it half-written
+        self._write_snapshot({'nodes': self.db, 'ids': self.ids.save(), 'versions': self.versions}, self.location + '.tmp')
+        os.replace(self.location + '.tmp', self.location)
+        self.file_stat = self._file_stat()
+
+    def save_nodes(self, node_ids):
+        with _file_lock(self.location + '.lock'):
+            if self.stale():
+                self._merge()
+            self._save_nodes(node_ids)
+
+    def _save_nodes(self, node_ids):
+        self.save()
+
+    def _merge(self):
+        # another process saved since we loaded, our changes are applied over what it saved
+        ours = {key: (self.db.get(key), self.versions.get(key), base) for (key, base) in self.unsaved.items()}
+        ids_state = self.ids.save()
+        cleared = not os.path.exists(self.location) # by another process
+        if cleared:
+            (self.db, self.versions) = ({}, {})
+        else:
+            self._load()
+        self.file_stat = self._file_stat()
+        conflicts = sorted(key for (key, (_, _, base)) in ours.items() if self.versions.get(key, 0) != base)
+        if conflicts:
+            self._reset()
+            raise ConflictError('nodes {} were changed by another process, the data were reloaded without our changes'.format(conflicts))
+        for (key, (node, version, base)) in ours.items():
+            self._write(key, node)
+            if node is not None:
+                self.versions[key] = version
+            else:
+                self.versions.pop(key, None)
+        self.ids.load(ids_state) # allocators keep the later of both states
+        if cleared:
+            self.save() # changes are saved over the whole data, e.g., logged over its snapshot
+        self._reset() # once the state is final, so that listeners see only what the other process changed
+        self.unsaved = {key: base for (key, (_, _, base)) in ours.items()}
+
+    def reserve_ids(self, start, size):
+        # the end of the ids reserved by all processes is kept aside, so that it is written without the nodes
+        location = self.location + '.ids'
+        with _file_lock(self.location + '.lock'):
+            try:
+                with open(location, "r", encoding='UTF-8') as file:
+                    start = max(start, json.load(file))
+            except FileNotFoundError:
+                pass
+            with open(location + '.tmp', "w", encoding='UTF-8') as file:
+                json.dump(start + size, file)
+            os.replace(location + '.tmp', location)
+        return start
+
+    def _read_snapshot(self):
+        with open(self.location, "r", encoding='UTF-8') as file:
+            return json.load(file)
+
+    def _write_snapshot(self, res, location):
+        with open(location, "w", encoding='UTF-8') as file:
             json.dump(res, file, indent=4)
 
+    def stale(self):
+        return self._file_stat() != self.file_stat
+
+    def _file_stat(self):
+        # identifies the version of the file on disk
+        return _stat(self.location)
+
     def clear(self):
         super().clear()
-        if os.path.exists(self.location):
-            os.remove(self.location)
+        for location in [self.location + '.ids', self.location + '.lock', self.location]:
+            if os.path.exists(location):
+                os.remove(location)
+
+
+class BinaryFileDB(FileDB):
+    '''
+    File database which stores its snapshot in the compact binary format of noosphere.binary.
+    '''
+
+    def _read_snapshot(self):
+        with open(self.location, "rb") as file:
+            return binary.load(file)
+
+    def _write_snapshot(self, res, location):
+        with open(location, "wb") as file:
+            binary.dump(res, file)
+
+
+class LogFileDB(FileDB):
+    '''
+    File database which appends each change to a log instead of rewriting the whole file.
+    Loading replays the log over the snapshot, compaction folds the log back into the snapshot.
+    A record torn by an interrupted write is skipped and the next one is appended on a new line.
+    '''
+
+    def __init__(self, location, compact_after=1000, trusted=False):
+        self.log_location = os.path.expanduser(location) + '.log'
+        self.compact_after = compact_after
+        self.log_size = 0
+        self.log_torn = False # whether the log does not end with a complete line
+        self.logged_ids = None
+        super().__init__(location, trusted)
+
+    def _load(self):
+        super()._load()
+        self.logged_ids = self.ids.save()
+        self.log_size = 0
+        self.log_torn = False
+        if os.path.exists(self.log_location):
+            with open(self.log_location, "r", encoding='UTF-8') as file:
+                for line in file:
+                    self.log_torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # incomplete record from an interrupted write
+                    self._replay(record)
+                    self.log_size += 1
+
+    def _replay(self, record):
+        if 'set' in record:
+            node = record['set']
+            self.db[str(node['id'])] = node
+            if 'version' in record:
+                self.versions[str(node['id'])] = record['version']
+        elif 'rem' in record:
+            self.db.pop(str(record['rem']), None)
+            self.versions.pop(str(record['rem']), None)
+        elif 'ids' in record:
+            self.ids.load(record['ids'])
+            self.logged_ids = record['ids']
+
+    def _save_nodes(self, node_ids):
+        records = []
+        ids_state = self.ids.save()
+        if ids_state != self.logged_ids:
+            records.append({'ids': ids_state})
+            self.logged_ids = ids_state
+        for node_id in node_ids:
+            node = self.db.get(str(node_id))
+            if node is None:
+                records.append({'rem': node_id})
+            else:
+                records.append({'set': node, 'version': self.versions.get(str(node_id), 0)})
+        with open(self.log_location, "a", encoding='UTF-8') as file:
+            file.write(('\n' if self.log_torn else '') + ''.join(json.dumps(x, separators=(',', ':')) + '\n' for x in records))
+        self.log_torn = False
+        self.log_size += len(records)
+        self.file_stat = self._file_stat()
+        if self.compact_after is not None and self.log_size >= self.compact_after:
+            self.compact()
+
+    def save(self):
+        self.compact()
+
+    def compact(self):
+        '''write a fresh snapshot and truncate the log'''
+        super().save()
+        self.logged_ids = self.ids.save()
+        self.log_size = 0
+        self.log_torn = False
+        if os.path.exists(self.log_location):
+            os.remove(self.log_location)
+        self.file_stat = self._file_stat()
+
+    def _file_stat(self):
+        return (super()._file_stat(), _stat(self.log_location))
+
+    def clear(self):
+        super().clear()
+        self.log_size = 0
+        self.log_torn = False
+        if os.path.exists(self.log_location):
+            os.remove(self.log_location)
+
+
+class IndexedFileDB(MemoryDB):
+    '''
+    File database which reads nodes only when they are asked for.
+    Nodes are appended to the data file one per line and a sidecar index maps their ids to the position in the file.
+    Loading reads only the index, nodes are decoded from the memory-mapped data file on demand.
+    An index record torn by an interrupted write is skipped and the next one is appended on a new line.
+    '''
+
+    def __init__(self, location, trusted=False):
+        super().__init__(trusted)
+        self.location = os.path.expanduser(location)
+        self.index_location = self.location + '.idx'
+        self.mapped = None
+        self.load()
+
+    def load(self):
+        self.ids = copy.deepcopy(self.orig_ids)
+        self.offsets = {} # node key -> (offset, length) in the data file
+        self.dirty = {} # nodes which were changed but not written yet, None if removed
+        self.garbage = 0 # bytes of the data file taken by outdated nodes
+        self.index_torn = False # whether the index does not end with a complete line
+        if os.path.exists(self.index_location):
+            with open(self.index_location, "r", encoding='UTF-8') as file:
+                content = file.read()
+            self.index_torn = not content.endswith('\n') and content != ''
+            lines = content.splitlines()
+            try: # parsing the whole index at once is considerably faster
+                records = json.loads('[' + ','.join(lines) + ']')
+            except ValueError:
+                records = []
+                for line in lines:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue # incomplete record from an interrupted write
+            for record in records:
+                self._read_index_record(record)
+        self.written_ids = self.ids.save()
+        self._map()
+        self._reset()
+        self.file_stat = self._file_stat()
+
+    def _read_index_record(self, record):
+        if isinstance(record, dict):
+            self.ids.load(record['ids'])
+            return
+        (key, offset, length) = record
+        if key in self.offsets:
+            self.garbage += self.offsets.pop(key)[1]
+        if length != 0:
+            self.offsets[key] = (offset, length)
+
+    def _map(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        if os.path.exists(self.location) and os.path.getsize(self.location) > 0:
+            with open(self.location, "rb") as file:
+                self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def save(self):
+        ids_state = self.ids.save()
+        if not self.dirty and ids_state == self.written_ids:
+            return
+        index_records = []
+        if ids_state != self.written_ids:
+            index_records.append({'ids': ids_state})
+            self.written_ids = ids_state
+        # data are written before the index so that the index never points to missing data
+        with open(self.location, "ab") as file:
+            offset = file.tell()
+            for (key, node) in self.dirty.items():
+                if key in self.offsets:
+                    self.garbage += self.offsets.pop(key)[1]
+                if node is None:
+                    index_records.append([key, 0, 0])
+                    continue
+                record = json.dumps(node, separators=(',', ':')).encode('UTF-8') + b'\n'
+                file.write(record)
+                self.offsets[key] = (offset, len(record))
+                index_records.append([key, offset, len(record)])
+                offset += len(record)
+        with open(self.index_location, "a", encoding='UTF-8') as file:
+            file.write(('\n' if self.index_torn else '') + ''.join(json.dumps(x, separators=(',', ':')) + '\n' for x in index_records))
+        self.index_torn = False
+        self.dirty = {}
+        self._map()
+        self.file_stat = self._file_stat()
+        if self.garbage * 2 > offset:
+            self.compact()
+
+    def save_nodes(self, node_ids):
+        self.save()
+
+    def compact(self):
+        '''rewrite the data file without outdated nodes'''
+        self.save()
+        offsets = {}
+        offset = 0
+        with open(self.location + '.tmp', "wb") as file:
+            for key in sorted(self.offsets):
+                record = self._raw(key)
+                file.write(record)
+                offsets[key] = (offset, len(record))
+                offset += len(record)
+        with open(self.index_location + '.tmp', "w", encoding='UTF-8') as file:
+            file.write(json.dumps({'ids': self.ids.save()}) + '\n')
+            for (key, (offset, length)) in offsets.items():
+                file.write(json.dumps([key, offset, length], separators=(',', ':')) + '\n')
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        os.replace(self.location + '.tmp', self.location)
+        os.replace(self.index_location + '.tmp', self.index_location)
+        self.index_torn = False
+        self.offsets = offsets
+        self.garbage = 0
+        self._map()
+        self.file_stat = self._file_stat()
+
+    def stale(self):
+        return self._file_stat() != self.file_stat
+
+    def _file_stat(self):
+        return (_stat(self.location), _stat(self.index_location))
+
+    def clear(self):
+        super().clear()
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        for location in [self.location, self.index_location]:
+            if os.path.exists(location):
+                os.remove(location)
+        self.offsets = {}
+        self.dirty = {}
+        self.garbage = 0
+        self.index_torn = False
+        self.written_ids = None
+
+    #== Storage =================================================================
+
+    def _raw(self, key):
+        (offset, length) = self.offsets[key]
+        return self.mapped[offset:offset+length]
+
+    def _node(self, key):
+        if key in self.dirty:
+            return self.dirty[key]
+        if key not in self.offsets:
+            return None
+        return json.loads(self._raw(key))
+
+    def _has(self, key):
+        if key in self.dirty:
+            return self.dirty[key] is not None
+        return key in self.offsets
+
+    def _nodes(self):
+        return (self._node(x) for x in self.keys())
+
+    def _keys(self):
+        keys = set(self.offsets)
+        for (key, node) in self.dirty.items():
+            if node is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return keys
+
+    def _write(self, key, node):
+        self.dirty[key] = node
+
+    def other_referrers(self, node_id):
+        if self.refs.entries is not None:
+            return super().other_referrers(node_id)
+        # the data file is searched at once, building the adjacency would decode all nodes
+        pattern = _reference_pattern(node_id)
+        if self.mapped is None or self.mapped.find(pattern) < 0:
+            keys = [x for (x, node) in self.dirty.items() if node is not None]
+        else:
+            keys = [x for x in self._keys() if x in self.dirty or pattern in self._raw(x)]
+        return _other_referrers(map(self._node, keys), node_id)
+
+    def snapshot(self):
+        return IndexedSnapshot(dict(self.offsets), dict(self.dirty), self.location)
+
+    def _updated_snapshot(self, snapshot, keys):
+        if snapshot.overlaid() + len(keys) > LAYERED_MAX:
+            return self.snapshot()
+        return snapshot.updated({key: self._node(key) for key in keys})
+
+
+class ShardedFileDB(MemoryDB):
+    '''
+    File database split into many files within a directory.
+    Nodes are assigned to shards by a hash of their id, the manifest holds the ids state and the root loader.
+    Shards are read when a node of theirs is asked for and only the changed shards are rewritten.
+    Several processes may write to the same directory. Changes are saved under a lock of the directory;
+    shards which another process saved meanwhile are read again and ours are kept unless both changed the same node.
+    '''
+
+    def __init__(self, location, shards=64, trusted=False):
+        super().__init__(trusted)
+        self.location = os.path.expanduser(location)
+        self.manifest_location = os.path.join(self.location, 'manifest.json')
+        self.shard_count = shards
+        self.load()
+
+    def load(self):
+        self.ids = copy.deepcopy(self.orig_ids)
+        self.shards = {} # shard number -> nodes of the loaded shard by their keys
+        self.shard_stats = {} # shard number -> version of its file when it was read or written
+        self.dirty = set() # shards changed since the last save
+        self.shared = set() # loaded shards which a snapshot shares, they are copied before they are changed
+        self.bases = {} # node key -> the node as it was read, for nodes changed since the last save
+        self.root = None
+        if os.path.exists(self.manifest_location):
+            with open(self.manifest_location, "r", encoding='UTF-8') as file:
+                manifest = json.load(file)
+            self.shard_count = manifest['shards']
+            self.ids.load(manifest['ids'])
+            self.root = manifest['root']
+        self.written_manifest = self._manifest()
+        self._reset()
+        self.file_stat = _stat(self.manifest_location)
+
+    def _manifest(self):
+        return {'shards': self.shard_count, 'ids': self.ids.save(), 'root': self.root}
+
+    def save(self):
+        os.makedirs(self.location, exist_ok=True)
+        with _file_lock(os.path.join(self.location, 'lock')):
+            self._merge()
+            self._save()
+        self.bases = {}
+
+    def _save(self):
+        # shards are written before the manifest so that the ids state never precedes the nodes
+        for number in sorted(self.dirty):
+            location = self._shard_location(number)
+            nodes = self.shards[number]
+            if nodes:
+                with open(location + '.tmp', "w", encoding='UTF-8') as file:
+                    json.dump(nodes, file, separators=(',', ':'))
+                os.replace(location + '.tmp', location)
+            elif os.path.exists(location):
+                os.remove(location)
+            self.shard_stats[number] = _stat(location)
+        self.dirty = set()
+        manifest = self._manifest()
+        if manifest != self.written_manifest or not os.path.exists(self.manifest_location):
+            with open(self.manifest_location + '.tmp', "w", encoding='UTF-8') as file:
+                json.dump(manifest, file, indent=4)
+            os.replace(self.manifest_location + '.tmp', self.manifest_location)
+            self.written_manifest = manifest
+        self.file_stat = _stat(self.manifest_location)
+
+    def save_nodes(self, node_ids):
+        self.save()
+
+    def _merge(self):
+        # the manifest and changed shards which another process saved since we read them are read again,
+        # our changes are applied over them
+        (theirs, conflicts) = ({}, [])
+        if _stat(self.manifest_location) not in (self.file_stat, None):
+            with open(self.manifest_location, "r", encoding='UTF-8') as file:
+                manifest = json.load(file)
+            self.ids.load(manifest['ids']) # allocators keep the later of both states
+            self.written_manifest = manifest
+            theirs['!0'] = manifest['root']
+        for number in self.dirty:
+            location = self._shard_location(number)
+            if _stat(location) == self.shard_stats.get(number):
+                continue
+            nodes = {}
+            if os.path.exists(location):
+                with open(location, "r", encoding='UTF-8') as file:
+                    nodes = json.load(file)
+            theirs[number] = nodes
+        if not theirs:
+            return
+        ours = {} # key -> our node, for nodes we changed within what is read again
+        for (key, base) in self.bases.items():
+            number = '!0' if key == '!0' else self._shard_number(key)
+            node = self._node(key)
+            if number in theirs and node != base:
+                other = theirs[number] if key == '!0' else theirs[number].get(key)
+                if other != base:
+                    conflicts.append(key)
+                ours[key] = node
+        if conflicts:
+            self.load()
+            raise ConflictError('nodes {} were changed by another process, the data were reloaded without our changes'.format(sorted(conflicts)))
+        if '!0' not in ours and '!0' in theirs:
+            self.root = theirs.pop('!0')
+        theirs.pop('!0', None)
+        for (key, node) in ours.items():
+            if key == '!0':
+                continue
+            nodes = theirs[self._shard_number(key)]
+            if node is None:
+                nodes.pop(key, None)
+            else:
+                nodes[key] = node
+        for (number, nodes) in theirs.items():
+            self.shards[number] = nodes
+            self.shared.discard(number)
+        self._reset() # nodes of the other process were read
+
+    def stale(self):
+        '''whether the manifest or any of the loaded shards was changed by someone else'''
+        if _stat(self.manifest_location) != self.file_stat:
+            return True
+        return any(_stat(self._shard_location(x)) != stat for (x, stat) in self.shard_stats.items())
+
+    def clear(self):
+        super().clear()
+        if os.path.isdir(self.location):
+            for name in os.listdir(self.location):
+                if name in ('manifest.json', 'lock') or name.startswith('shard-'):
+                    os.remove(os.path.join(self.location, name))
+        self.shards = {}
+        self.shard_stats = {}
+        self.dirty = set()
+        self.shared = set()
+        self.bases = {}
+        self.root = None
+        self.written_manifest = None
+
+    def snapshot(self):
+        res = ShardedSnapshot(self)
+        self.shared = set(self.shards)
+        return res
+
+    def _updated_snapshot(self, snapshot, keys):
+        if snapshot.overlaid() + len(keys) > LAYERED_MAX:
+            return self.snapshot()
+        return snapshot.updated({key: self._node(key) for key in keys})
+
+    #== Storage =================================================================
+
+    def _shard_number(self, key):
+        return _shard_number(key, self.shard_count)
+
+    def _shard_location(self, number):
+        return os.path.join(self.location, 'shard-{}.json'.format(number))
+
+    def _shard(self, number):
+        if number not in self.shards:
+            location = self._shard_location(number)
+            self.shard_stats[number] = _stat(location)
+            if self.shard_stats[number] is None:
+                self.shards[number] = {}
+            else:
+                with open(location, "r", encoding='UTF-8') as file:
+                    self.shards[number] = json.load(file)
+        return self.shards[number]
+
+    def _all_shards(self):
+        return [self._shard(x) for x in range(self.shard_count)]
+
+    def _node(self, key):
+        if key == '!0':
+            return self.root
+        return self._shard(self._shard_number(key)).get(key)
+
+    def _has(self, key):
+        return self._node(key) is not None
+
+    def _nodes(self):
+        nodes = [] if self.root is None else [self.root]
+        for shard in self._all_shards():
+            nodes.extend(shard.values())
+        return nodes
+
+    def _keys(self):
+        keys = [] if self.root is None else ['!0']
+        for shard in self._all_shards():
+            keys.extend(shard.keys())
+        return keys
+
+    def other_referrers(self, node_id):
+        if self.refs.entries is not None:
+            return super().other_referrers(node_id)
+        # shards which are not loaded are read only if they contain the reference
+        pattern = _reference_pattern(node_id)
+        nodes = [] if self.root is None else [self.root]
+        for number in range(self.shard_count):
+            if number not in self.shards:
+                try:
+                    with open(self._shard_location(number), "rb") as file:
+                        if pattern not in file.read():
+                            continue
+                except FileNotFoundError:
+                    continue
+            nodes.extend(self._shard(number).values())
+        return _other_referrers(nodes, node_id)
+
+    def _write(self, key, node):
+        if key not in self.bases:
+            self.bases[key] = self._node(key)
+        if key == '!0':
+            self.root = node
+            return
+        number = self._shard_number(key)
+        shard = self._shard(number)
+        if number in self.shared:
+            shard = self.shards[number] = dict(shard)
+            self.shared.discard(number)
+        if node is None:
+            shard.pop(key, None)
+        else:
+            shard[key] = node
+        self.dirty.add(number)
+
+
+class SqlIndex:
+    '''
+    Index of SqliteDB whose entries are kept in the attrs table.
+    '''
+
+    kind = 'sorted' # it answers range queries as well
+
+    def __init__(self, data, attr_id):
+        self.data = data
+        self.attr_id = attr_id
+
+    def changed(self, node_id, old_node, new_node):
+        key = str(node_id)
+        if old_node is not None and self.attr_id in old_node:
+            self.data.connection.execute('DELETE FROM attrs WHERE node = ? AND attr = ?', (key, self.attr_id))
+        if new_node is not None and self.attr_id in new_node:
+            rows = [(key, self.attr_id, -1, None)] # marks that the node has the attribute
+            rows += [(key, self.attr_id, kind, value) for (kind, value) in set(value_keys(new_node[self.attr_id]))]
+            self.data.connection.executemany('INSERT INTO attrs VALUES (?, ?, ?, ?)', rows)
+
+    def reset(self):
+        pass
+
+    def _select(self, condition, params):
+        cursor = self.data.connection.execute('SELECT DISTINCT node FROM attrs WHERE attr = ? AND ' + condition, (self.attr_id,) + params)
+        return set(x[0] for x in cursor)
+
+    def having(self):
+        return self._select('kind = -1', ())
+
+    def equal(self, value):
+        key = value_key(value)
+        if key is None:
+            return set()
+        return self._select('kind = ? AND value = ?', key)
+
+    def between(self, low, high):
+        bound = low if low is not None else high
+        if bound is None:
+            return self.having()
+        condition = 'kind = ?'
+        params = (value_key(bound)[0],)
+        if low is not None:
+            condition += ' AND value >= ?'
+            params += (low,)
+        if high is not None:
+            condition += ' AND value <= ?'
+            params += (high,)
+        return self._select(condition, params)
+
+
+class SqliteDB(MemoryDB):
+    '''
+    Database stored in an sqlite file, nodes are read and written one by one.
+    References and indexes are kept in tables so that they are answered by sqlite.
+    '''
+
+    SCAN_PAGE = 500 # nodes read from the database at once when scanning
+
+    def __init__(self, location, trusted=False):
+        super().__init__(trusted)
+        self.location = os.path.expanduser(location)
+        self.listeners.remove(self.refs) # references are kept in the refs table
+        self.connection = None
+        self.load()
+
+    def load(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.location, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(_SQLITE_SCHEMA)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'ids'").fetchone()
+        self.ids = copy.deepcopy(self.orig_ids)
+        if row is not None:
+            self.ids.load(json.loads(row[0]))
+        self.saved_ids = self.ids.save()
+        for (attr_id,) in self.connection.execute('SELECT attr FROM indexes').fetchall():
+            if attr_id not in self.indexes:
+                self._register_index(attr_id)
+        self._reset()
+        self.data_version = self._data_version()
+
+    def save(self):
+        ids_state = self.ids.save()
+        if ids_state != self.saved_ids:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('ids', ?)", (json.dumps(ids_state),))
+            self.saved_ids = ids_state
+        self.connection.commit()
+
+    def save_nodes(self, node_ids):
+        self.save()
+
+    def rollback(self):
+        super().rollback()
+        if self.batch_depth == 0:
+            self.connection.commit()
+
+    def stale(self):
+        return self._data_version() != self.data_version
+
+    def close(self):
+        self.connection.close()
+        self.connection = None
+
+    def snapshot(self):
+        '''committed nodes, changes of an open batch are not part of it'''
+        return SqliteSnapshot(self.location)
+
+    def _updated_snapshot(self, snapshot, keys):
+        return self.snapshot() # a new read transaction costs less than reading the changed nodes
+
+    def _data_version(self):
+        # changes whenever another connection commits to the database
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def clear(self):
+        super().clear()
+        for table in ['nodes', 'meta', 'refs', 'attrs']:
+            self.connection.execute('DELETE FROM ' + table)
+        self.saved_ids = None
+        self.save()
+
+    #== Storage =================================================================
+
+    def _copy(self, node):
+        return node # nodes are decoded anew on each read
+
+    def _node(self, key):
+        row = self.connection.execute('SELECT body FROM nodes WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _has(self, key):
+        return self.connection.execute('SELECT 1 FROM nodes WHERE id = ?', (key,)).fetchone() is not None
+
+    def _nodes(self):
+        return self._scan(None)
+
+    def _keys(self):
+        return [x[0] for x in self.connection.execute('SELECT id FROM nodes')]
+
+    def _scan(self, after):
+        last = '' if after is None else str(after)
+        while True:
+            rows = self.connection.execute('SELECT id, body FROM nodes WHERE id > ? ORDER BY id LIMIT ?', (last, self.SCAN_PAGE)).fetchall()
+            for (key, body) in rows:
+                yield json.loads(body)
+            if len(rows) < self.SCAN_PAGE:
+                return
+            last = rows[-1][0]
+
+    def _write(self, key, node):
+        self.connection.execute('DELETE FROM refs WHERE source = ?', (key,))
+        if node is None:
+            self.connection.execute('DELETE FROM nodes WHERE id = ?', (key,))
+            return
+        self.connection.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?)', (key, json.dumps(node, separators=(',', ':'))))
+        rows = [(key, attr_id, str(target_id)) for (attr_id, target_id) in node_references(node)]
+        self.connection.executemany('INSERT INTO refs VALUES (?, ?, ?)', rows)
+
+    #== Indexes =================================================================
+
+    def add_index(self, attr_id, kind='hash'):
+        # sqlite indexes answer both equality and range queries so the kind does not matter
+        if attr_id in self.indexes:
+            return
+        index = self._register_index(attr_id)
+        self.connection.execute('INSERT INTO indexes VALUES (?)', (attr_id,))
+        for node in self._nodes():
+            index.changed(node['id'], None, node)
+        self.connection.commit()
+
+    def remove_index(self, attr_id):
+        super().remove_index(attr_id)
+        self.connection.execute('DELETE FROM indexes WHERE attr = ?', (attr_id,))
+        self.connection.execute('DELETE FROM attrs WHERE attr = ?', (attr_id,))
+        self.connection.commit()
+
+    def _register_index(self, attr_id):
+        index = SqlIndex(self, attr_id)
+        self.indexes[attr_id] = index
+        self.listeners.append(index)
+        return index
+
+    def referrers(self, node_id, attr_id=None):
+        if attr_id is None:
+            cursor = self.connection.execute('SELECT DISTINCT source FROM refs WHERE target = ? ORDER BY source', (str(node_id),))
+        else:
+            cursor = self.connection.execute('SELECT DISTINCT source FROM refs WHERE target = ? AND attr = ? ORDER BY source', (str(node_id), attr_id))
+        return [x[0] for x in cursor]
+
+    def references(self, node_id, attr_id=None):
+        if attr_id is None:
+            cursor = self.connection.execute('SELECT DISTINCT target FROM refs WHERE source = ? ORDER BY target', (str(node_id),))
+        else:
+            cursor = self.connection.execute('SELECT DISTINCT target FROM refs WHERE source = ? AND attr = ? ORDER BY target', (str(node_id), attr_id))
+        return [x[0] for x in cursor]
+
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (id TEXT PRIMARY KEY, body TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS refs (source TEXT NOT NULL, attr TEXT NOT NULL, target TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS refs_target ON refs (target, attr);
+CREATE INDEX IF NOT EXISTS refs_source ON refs (source);
+CREATE TABLE IF NOT EXISTS indexes (attr TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS attrs (node TEXT NOT NULL, attr TEXT NOT NULL, kind INTEGER NOT NULL, value);
+CREATE INDEX IF NOT EXISTS attrs_value ON attrs (attr, kind, value);
+CREATE INDEX IF NOT EXISTS attrs_node ON attrs (node, attr);
+'''
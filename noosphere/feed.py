@@ -0,0 +1,177 @@
+'''
+Ordered stream of changes of the graph, see Graph.changes and Graph.subscribe.
+
+Each change is a dict with its sequence number "seq", operation "op" (insert, update, or remove),
+the node "id", and read-only views of the node "before" and "after" the change, None where the node does not exist.
+Stored nodes are never altered in place, so the views need no copies; see plain for changes which may be altered.
+Changes of a batch are published together when it is committed and dropped when it is rolled back.
+After a load, changes saved by other processes are published from the versions of nodes with "before" being None;
+databases which do not persist the versions publish a single change with op "reset" meaning that anything may have changed.
+'''
+
+import threading
+import collections
+
+from noosphere import NosError
+from noosphere.data import NodeView
+
+RETAINED = 10000 # number of the latest changes kept for readers which resume
+
+
+class ChangeFeed:
+    '''
+    Listener of a database which numbers its committed changes and keeps the latest of them.
+    '''
+
+    def __init__(self, data, retained=RETAINED):
+        self.data = data
+        self.changes = collections.deque(maxlen=retained)
+        self.last = 0 # sequence number of the latest change
+        self.pending = {} # changes of the open batch by node keys, in the order of the first change
+        self.subscriptions = []
+        self.versions = dict(data.versions) if data.versioned else None
+        self.condition = threading.Condition()
+
+    #== Listener of the data ====================================================
+
+    def changed(self, node_id, old_node, new_node):
+        key = str(node_id)
+        if self.versions is not None:
+            self.versions[key] = self.data.versions.get(key)
+        if key in self.pending:
+            (_, before, _) = self.pending[key]
+        else:
+            before = None if old_node is None else NodeView(old_node)
+        self.pending[key] = (node_id, before, None if new_node is None else NodeView(new_node))
+        if self.data.batch_depth == 0:
+            self.flush()
+
+    def reset(self):
+        (pending, self.pending) = (self.pending, {})
+        if self.data.batch_depth == 0:
+            # committed changes end as the new state has the nodes, e.g., when they were merged with changes of others
+            for (key, (node_id, before, _)) in pending.items():
+                node = self.data._node(key)
+                self.pending[key] = (node_id, before, None if node is None else NodeView(node))
+            self.flush()
+        else:
+            pending = {}
+        if self.versions is None:
+            self._publish([_change('reset', None, None, None)])
+            return
+        (old_versions, self.versions) = (self.versions, dict(self.data.versions))
+        changes = []
+        for (key, version) in self.versions.items():
+            if old_versions.get(key) != version and key not in pending:
+                node = self.data._node(key)
+                changes.append(_change('insert' if key not in old_versions else 'update', node['id'], None, NodeView(node)))
+        for key in old_versions:
+            if key not in self.versions and key not in pending:
+                changes.append(_change('remove', key, None, None))
+        self._publish(changes)
+
+    #== Batches =================================================================
+
+    def flush(self):
+        '''publish the changes of the committed batch'''
+        (pending, self.pending) = (self.pending, {})
+        changes = []
+        for (node_id, before, after) in pending.values():
+            if before == after:
+                continue # the node was changed back
+            op = 'insert' if before is None else 'remove' if after is None else 'update'
+            changes.append(_change(op, node_id, before, after))
+        self._publish(changes)
+
+    def discard(self):
+        '''drop the changes of the rolled back batch'''
+        (pending, self.pending) = (self.pending, {})
+        if self.versions is not None:
+            for key in pending:
+                self.versions[key] = self.data.versions.get(key)
+
+    def _publish(self, changes):
+        if not changes:
+            return
+        with self.condition:
+            for change in changes:
+                self.last += 1
+                change['seq'] = self.last
+                self.changes.append(change)
+            self.condition.notify_all()
+        for subscription in list(self.subscriptions):
+            for change in changes:
+                subscription.notify(change)
+
+    #== Readers =================================================================
+
+    def since(self, after, predicate=None):
+        '''retained changes after the sequence number which concern nodes satisfying the predicate before or after the change'''
+        return self.poll(after, predicate)[0]
+
+    def poll(self, after, predicate=None):
+        '''pair of the changes since the sequence number and the number to continue after'''
+        with self.condition:
+            last = self.last
+            if after is None or after == last:
+                return ([], last)
+            if after > last:
+                raise NosError('there is no change {}, the latest is {}'.format(after, last))
+            if after < last - len(self.changes):
+                raise NosError('changes after {} are no longer retained, the latest is {}'.format(after, last))
+            start = len(self.changes) - (last - after)
+            changes = [self.changes[x] for x in range(start, len(self.changes))]
+        return ([x for x in changes if _concerns(x, predicate)], last)
+
+    def wait(self, after, timeout=None):
+        '''waits until there is a change after the sequence number, returns whether there is one'''
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last > after, timeout)
+
+    def subscribe(self, callback, predicate=None, after=None):
+        '''
+        Calls the callback with each change concerning nodes which satisfy the predicate, see since.
+        Given a sequence number, retained changes after it are passed first.
+        Callbacks run in the thread which commits the changes.
+        '''
+        subscription = Subscription(self, callback, predicate)
+        for change in self.since(after, predicate):
+            callback(change)
+        self.subscriptions.append(subscription)
+        return subscription
+
+
+class Subscription:
+    '''
+    Callback receiving changes of a feed until it is cancelled.
+    '''
+
+    def __init__(self, feed, callback, predicate):
+        self.feed = feed
+        self.callback = callback
+        self.predicate = predicate
+
+    def notify(self, change):
+        if _concerns(change, self.predicate):
+            self.callback(change)
+
+    def cancel(self):
+        if self in self.feed.subscriptions:
+            self.feed.subscriptions.remove(self)
+
+
+def plain(change):
+    '''copy of the change with nodes which may be altered, e.g., to be sent as json'''
+    res = dict(change)
+    for side in ('before', 'after'):
+        if res[side] is not None:
+            res[side] = res[side].copy()
+    return res
+
+def _change(op, node_id, before, after):
+    return {'seq': None, 'op': op, 'id': node_id, 'before': before, 'after': after}
+
+def _concerns(change, predicate):
+    if predicate is None or change['op'] == 'reset':
+        return True
+    return any(x is not None and predicate(x) for x in (change['before'], change['after']))
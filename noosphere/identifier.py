@@ -1,24 +1,26 @@
 '''
 Managing identifiers within a database.
+
+Allocators hand out ids in blocks; a candidate is checked against the database by db.contains, which is O(1) for nodes held in memory.
+Blocks of integer ids are reserved by db.reserve_ids, so databases shared by processes can keep them apart.
+Allocation is serialized by a lock, so a database may be shared by threads.
 '''
 
 import random
+import string
+import threading
+
+ALPHABET = string.digits + string.ascii_lowercase + string.ascii_uppercase
 
-def _rand_alphanum():
-    rnd = random.randrange(0, 2*26+10)
-    if(rnd < 10):
-        return str(rnd)
-    rnd -= 10
-    if(rnd < 26):
-        return chr(ord('a') + rnd)
-    rnd -= 26
-    return chr(ord('A') + rnd)
+# allocators are copied with their databases, so they share a single lock
+_lock = threading.Lock()
 
 
 class AlphaNumId:
     '''
     Saves ID as an alphanumeric string value of given length.
     It always starts with '!' character.
+    Ids are random, so processes sharing the persisted data are unlikely to pick the same one.
     '''
 
     def __init__(self, length):
@@ -37,22 +39,51 @@ class AlphaNumId:
             return entry_id[0] == '!' and entry_id[1:].isalnum() and len(entry_id) == self.length+1
 
     def new_id(self, db):
-        while True:
-            new_id = [_rand_alphanum() for _ in range(self.length)]
-            if(db.get(new_id) is None):
-                return '!' + new_id
+        return self.new_ids(db, 1)[0]
+
+    def new_ids(self, db, count):
+        '''count distinct ids which are not used in the database'''
+        space = len(ALPHABET) ** self.length
+        bits = space.bit_length()
+        res = []
+        issued = set()
+        with _lock:
+            while len(res) < count:
+                number = random.getrandbits(bits)
+                if number >= space:
+                    continue # rejected so that all ids are equally likely
+                new_id = '!' + self._encode(number)
+                if new_id in issued or db.contains(new_id):
+                    continue
+                issued.add(new_id)
+                res.append(new_id)
+        return res
+
+    def _encode(self, number):
+        chars = []
+        for _ in range(self.length):
+            (number, digit) = divmod(number, len(ALPHABET))
+            chars.append(ALPHABET[digit])
+        return ''.join(chars)
 
 
 class IntId:
     '''
     Saves ID as an integer.
+    Ids are handed out from a block which the database reserves for this allocator,
+    the persisted state is the end of the reserved ids. Loading never moves it back,
+    so neither a load nor a rollback gives up the rest of the block.
     '''
 
+    BLOCK = 1024
+
     def __init__(self):
-        self.last_id = 100
+        self.last_id = 100 # end of the ids reserved so far
+        self.next_id = self.last_id
+        self.block_end = self.last_id # end of the block the ids are handed out from
 
     def load(self, saved_sata):
-        self.last_id = saved_sata['last_id']
+        self.last_id = max(self.last_id, saved_sata['last_id'])
 
     def save(self):
         return {'last_id': self.last_id}
@@ -61,8 +92,20 @@ class IntId:
         return isinstance(entry_id, int)
 
     def new_id(self, db):
-        res_id = self.last_id
-        if db.get(res_id) is not None:
-            res_id += 1
-        self.last_id = res_id + 1
-        return res_id
+        return self.new_ids(db, 1)[0]
+
+    def new_ids(self, db, count):
+        '''count unused ids in increasing order, skipping those already in the database'''
+        res = []
+        with _lock:
+            while len(res) < count:
+                if self.next_id >= self.block_end:
+                    size = max(self.BLOCK, count - len(res))
+                    self.next_id = db.reserve_ids(self.last_id, size)
+                    self.block_end = self.next_id + size
+                    self.last_id = max(self.last_id, self.block_end)
+                res_id = self.next_id
+                self.next_id += 1
+                if not db.contains(res_id):
+                    res.append(res_id)
+        return res
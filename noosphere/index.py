@@ -0,0 +1,392 @@
+'''
+Indexes over attribute values which the database keeps up to date.
+
+An index is notified about every change of a node and it is rebuilt lazily
+once the whole database is replaced, e.g., when it is loaded.
+Values are indexed by their key which distinguishes booleans, numbers, strings, and references.
+Arrays are indexed under each of their elements.
+References between nodes are kept by RefIndex which serves as the adjacency of the graph.
+
+Readers of a snapshot share its indexes, so an index is built under a lock and it is used only once it is complete.
+Indexes of the next snapshot reuse the built ones, see OverlayIndex.
+'''
+
+import math
+import bisect
+import operator
+import threading
+from collections.abc import Mapping
+
+_BOOL, _NUMBER, _STR, _REF = range(4)
+_MAPPINGS = (dict, Mapping) # plain dicts are checked first as it is considerably faster
+
+def value_key(value):
+    '''Key under which a primitive value is indexed, None if the value is not indexable.'''
+    if isinstance(value, bool):
+        return (_BOOL, value)
+    if isinstance(value, (int, float)):
+        return (_NUMBER, value)
+    if isinstance(value, str):
+        return (_STR, value)
+    if isinstance(value, Mapping) and 'id' in value:
+        return (_REF, value['id'])
+    return None
+
+def value_keys(value):
+    '''Keys of an attribute value, one for each element of an array.'''
+    if isinstance(value, (list, tuple)):
+        keys = map(value_key, value)
+    else:
+        keys = [value_key(value)]
+    return [x for x in keys if x is not None]
+
+
+class Index:
+    '''
+    Base of indexes over a single attribute.
+    '''
+
+    def __init__(self, data, attr_id):
+        self.data = data
+        self.attr_id = attr_id
+        self.nodes = None # ids of nodes which have the attribute, set once the index is built
+        self.size = 0 # number of nodes the index was built from
+        self.lock = threading.Lock()
+
+    def changed(self, node_id, old_node, new_node):
+        if self.nodes is None:
+            return
+        if old_node is not None and self.attr_id in old_node:
+            self.nodes.discard(node_id)
+            for key in set(value_keys(old_node[self.attr_id])):
+                self._remove(key, node_id)
+        if new_node is not None and self.attr_id in new_node:
+            self.nodes.add(node_id)
+            for key in set(value_keys(new_node[self.attr_id])):
+                self._add(key, node_id)
+
+    def reset(self):
+        self.nodes = None
+
+    def built(self):
+        return self.nodes is not None
+
+    def _build(self):
+        if self.nodes is not None:
+            return
+        with self.lock:
+            if self.nodes is None:
+                self._fill()
+
+    def _fill(self):
+        self._clear()
+        nodes = set()
+        self.size = 0
+        for node in self.data._nodes(): # stored nodes are read without views as they are not altered
+            self.size += 1
+            if self.attr_id in node:
+                nodes.add(node['id'])
+                for key in set(value_keys(node[self.attr_id])):
+                    self._add(key, node['id'])
+        self.nodes = nodes
+
+    def having(self):
+        '''ids of nodes which contain the attribute'''
+        self._build()
+        return set(self.nodes)
+
+    def equal(self, value):
+        '''ids of nodes whose attribute equals to the value or contains it'''
+        raise NotImplementedError()
+
+    def between(self, low, high):
+        '''ids of nodes with a value in the inclusive range, None if not supported'''
+        return None
+
+    def counts(self):
+        '''number of nodes for each key of the values'''
+        raise NotImplementedError()
+
+
+class HashIndex(Index):
+    '''
+    Maps attribute values to nodes, answers equality queries.
+    '''
+
+    kind = 'hash'
+
+    def _clear(self):
+        self.entries = {}
+
+    def _add(self, key, node_id):
+        self.entries.setdefault(key, set()).add(node_id)
+
+    def _remove(self, key, node_id):
+        ids = self.entries.get(key)
+        if ids is not None:
+            ids.discard(node_id)
+            if not ids:
+                del self.entries[key]
+
+    def equal(self, value):
+        self._build()
+        key = value_key(value)
+        return set(self.entries.get(key, ()))
+
+    def counts(self):
+        self._build()
+        return {key: len(ids) for (key, ids) in self.entries.items()}
+
+
+class SortedIndex(Index):
+    '''
+    Keeps attribute values sorted, answers both equality and range queries.
+    '''
+
+    kind = 'sorted'
+
+    def _clear(self):
+        self.keys = []
+        self.ids = []
+
+    def _fill(self):
+        # sorted at once, inserting nodes one by one would take quadratic time
+        nodes = set()
+        pairs = []
+        self.size = 0
+        for node in self.data._nodes():
+            self.size += 1
+            if self.attr_id in node:
+                nodes.add(node['id'])
+                pairs.extend((key, node['id']) for key in set(value_keys(node[self.attr_id])))
+        pairs.sort(key=operator.itemgetter(0)) # the sort is stable, so nodes with equal keys are not compared
+        self.keys = [x[0] for x in pairs]
+        self.ids = [x[1] for x in pairs]
+        self.nodes = nodes
+
+    def _add(self, key, node_id):
+        pos = bisect.bisect_right(self.keys, key)
+        self.keys.insert(pos, key)
+        self.ids.insert(pos, node_id)
+
+    def _remove(self, key, node_id):
+        pos = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key)
+        for i in range(pos, end):
+            if self.ids[i] == node_id:
+                del self.keys[i]
+                del self.ids[i]
+                return
+
+    def _range(self, low_key, high_key):
+        pos = bisect.bisect_left(self.keys, low_key)
+        end = bisect.bisect_right(self.keys, high_key)
+        return set(self.ids[pos:end])
+
+    def equal(self, value):
+        self._build()
+        key = value_key(value)
+        return self._range(key, key)
+
+    def between(self, low, high):
+        self._build()
+        bound = low if low is not None else high
+        if bound is None:
+            return self.having()
+        kind = value_key(bound)[0]
+        low_key = (kind,) if low is None else value_key(low)
+        high_key = (kind+1,) if high is None else value_key(high)
+        return self._range(low_key, high_key)
+
+    def counts(self):
+        self._build()
+        res = {}
+        for key in self.keys:
+            res[key] = res.get(key, 0) + 1
+        return res
+
+
+def node_references(node):
+    '''Pairs of attribute id and referenced id for each reference within the node.'''
+    for (attr_id, value) in node.items():
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, _MAPPINGS) and len(item) == 1 and 'id' in item:
+                    yield (attr_id, item['id'])
+        elif isinstance(value, _MAPPINGS) and len(value) == 1 and 'id' in value:
+            yield (attr_id, value['id'])
+
+
+class RefIndex:
+    '''
+    Adjacency of nodes given by their references, in both directions.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.entries = None # referenced id -> referencing id -> attribute ids, set once the index is built
+        self.targets = None # referencing id -> referenced id -> attribute ids
+        self.size = 0 # number of nodes the index was built from
+        self.lock = threading.Lock()
+
+    def changed(self, node_id, old_node, new_node):
+        if self.entries is None:
+            return
+        if old_node is not None:
+            self.targets.pop(node_id, None)
+            for (attr_id, target_id) in node_references(old_node):
+                sources = self.entries.get(target_id)
+                if sources is not None and node_id in sources:
+                    sources[node_id].discard(attr_id)
+                    if not sources[node_id]:
+                        del sources[node_id]
+                    if not sources:
+                        del self.entries[target_id]
+        if new_node is not None:
+            for (attr_id, target_id) in node_references(new_node):
+                self.entries.setdefault(target_id, {}).setdefault(node_id, set()).add(attr_id)
+                self.targets.setdefault(node_id, {}).setdefault(target_id, set()).add(attr_id)
+
+    def reset(self):
+        self.entries = None
+        self.targets = None
+
+    def built(self):
+        return self.entries is not None
+
+    def _build(self):
+        if self.entries is not None:
+            return
+        with self.lock:
+            if self.entries is not None:
+                return
+            (entries, targets) = ({}, {})
+            self.size = 0
+            for node in self.data._nodes(): # stored nodes are read without views as they are not altered
+                self.size += 1
+                for (attr_id, target_id) in node_references(node):
+                    entries.setdefault(target_id, {}).setdefault(node['id'], set()).add(attr_id)
+                    targets.setdefault(node['id'], {}).setdefault(target_id, set()).add(attr_id)
+            self.targets = targets
+            self.entries = entries
+
+    def referrers(self, node_id, attr_id=None):
+        '''ids of nodes which reference the node, optionally only via the given attribute'''
+        self._build()
+        sources = self.entries.get(node_id, {})
+        return [x for (x, attrs) in sources.items() if attr_id is None or attr_id in attrs]
+
+    def references(self, node_id, attr_id=None):
+        '''ids of nodes which the node references, optionally only via the given attribute'''
+        self._build()
+        targets = self.targets.get(node_id, {})
+        return [x for (x, attrs) in targets.items() if attr_id is None or attr_id in attrs]
+
+
+OVERLAY_MIN = 1024 # number of changed nodes an index of an earlier snapshot is reused with in any case
+
+
+def overlay(index, data, changes):
+    '''
+    Index of the data which reuses the built index of an earlier snapshot, None if there is none or it is not worth it.
+    The changes map keys of the nodes changed since that snapshot to pairs of their ids and nodes in it, None if missing.
+    Once the changes outnumber the square root of all nodes, a new index takes less time than applying them.
+    '''
+    if isinstance(index, OverlayIndex):
+        merged = dict(index.changes)
+        for (key, change) in changes.items():
+            merged.setdefault(key, change) # nodes are kept as they were in the snapshot of the base
+        (index, changes) = (index.base, merged)
+    if not index.built() or len(changes) > max(OVERLAY_MIN, math.isqrt(index.size)):
+        return None
+    return OverlayIndex(data, index, changes)
+
+
+class OverlayIndex:
+    '''
+    Index of a snapshot made of a built index of an earlier snapshot and of the nodes changed since, see overlay.
+    The changed nodes are indexed apart on the first use, both before and after the changes.
+    Queries are answered by the base without the changed nodes together with the changed nodes as they are now.
+    '''
+
+    def __init__(self, data, base, changes):
+        self.data = data
+        self.base = base
+        self.changes = changes
+        self.attr_id = getattr(base, 'attr_id', None)
+        self.kind = getattr(base, 'kind', None)
+        self.lock = threading.Lock()
+        self.ids = None # ids of the changed nodes
+        self.before = None # index of the changed nodes as they were in the snapshot of the base
+        self.after = None # index of the changed nodes as they are now, set last
+
+    def changed(self, node_id, old_node, new_node):
+        pass # snapshots do not change
+
+    def reset(self):
+        pass
+
+    def built(self):
+        return True
+
+    def _build(self):
+        if self.after is not None:
+            return
+        with self.lock:
+            if self.after is not None:
+                return
+            self.ids = {node_id for (node_id, _) in self.changes.values()}
+            self.before = self._index([node for (_, node) in self.changes.values() if node is not None])
+            self.after = self._index([x for x in map(self.data._node, self.changes) if x is not None])
+
+    def _index(self, nodes):
+        data = _Nodes(nodes)
+        res = RefIndex(data) if isinstance(self.base, RefIndex) else type(self.base)(data, self.attr_id)
+        res._build()
+        return res
+
+    def having(self):
+        self._build()
+        return (self.base.having() - self.ids) | self.after.having()
+
+    def equal(self, value):
+        self._build()
+        return (self.base.equal(value) - self.ids) | self.after.equal(value)
+
+    def between(self, low, high):
+        self._build()
+        res = self.base.between(low, high)
+        if res is None:
+            return None
+        return (res - self.ids) | self.after.between(low, high)
+
+    def counts(self):
+        self._build()
+        res = self.base.counts()
+        for (key, count) in self.before.counts().items():
+            res[key] -= count
+            if res[key] == 0:
+                del res[key]
+        for (key, count) in self.after.counts().items():
+            res[key] = res.get(key, 0) + count
+        return res
+
+    def referrers(self, node_id, attr_id=None):
+        self._build()
+        res = [x for x in self.base.referrers(node_id, attr_id) if x not in self.ids]
+        return res + self.after.referrers(node_id, attr_id)
+
+    def references(self, node_id, attr_id=None):
+        self._build()
+        if node_id in self.ids:
+            return self.after.references(node_id, attr_id)
+        return self.base.references(node_id, attr_id)
+
+
+class _Nodes:
+    # stands in for the data when a few nodes are indexed apart
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def _nodes(self):
+        return self.nodes
@@ -0,0 +1,115 @@
+'''
+Results of queries which are kept up to date as the nodes change, see Graph.materialize.
+
+The predicate and the projection are given read-only views of single nodes, so they should depend only on the given node.
+Projections are kept as plain data, views they return are copied, so the results may be sent as json.
+Nodes on which the predicate or the projection fails are left out of the results, as the queries may come from clients.
+'''
+
+from noosphere.data import NodeView, copy_value
+
+
+class MaterializedView:
+    '''
+    Listener of a database which keeps ids of the nodes satisfying the predicate together with their projections.
+    Results are computed on the first read and whenever the stored nodes were replaced all at once, e.g., by a load.
+    '''
+
+    def __init__(self, data, predicate, projection=None):
+        self.data = data
+        self.predicate = predicate
+        self.projection = projection
+        self.matches = _Tolerant(predicate)
+        self.results = None # node key -> (node id, projection)
+        self.order = None # sorted keys of the results
+        self.published = None # copy of the results given to readers, None if the results changed since
+
+    def changed(self, node_id, old_node, new_node):
+        if self.results is None:
+            return
+        key = str(node_id)
+        view = None if new_node is None else NodeView(new_node)
+        entry = self._entry(view) if view is not None and self.matches(view) else None
+        if entry is not None:
+            if key not in self.results:
+                self.order = None
+            self.results[key] = entry
+            self.published = None
+        elif self.results.pop(key, None) is not None:
+            self.order = None
+            self.published = None
+
+    def reset(self):
+        self.results = None
+        self.order = None
+        self.published = None
+
+    def _build(self):
+        if self.results is not None:
+            return
+        results = {} # filled before it is set, as readers of a published state may build it at once
+        for view in self.data.query(self.matches):
+            entry = self._entry(view)
+            if entry is not None:
+                results[str(view['id'])] = entry
+        self.results = results
+
+    def _entry(self, view):
+        try:
+            return (view['id'], self._project(view))
+        except Exception: # the projection failed on the node
+            return None
+
+    def _project(self, view):
+        if self.projection is None:
+            return None # nodes are read when asked for
+        return copy_value(self.projection(view))
+
+    def reader(self, data):
+        '''
+        Read-only view of the results as they are now over the data of a published state, see SharedGraph.
+        The results are built here once and copied only when they changed since the last copy.
+        '''
+        self._build()
+        if self.published is None:
+            self.published = dict(self.results)
+        view = MaterializedView(data, self.predicate, self.projection)
+        (view.results, view.order) = (self.published, self.order)
+        return view
+
+    def rows(self):
+        '''results ordered by the node ids, either copies of the nodes or their projections'''
+        if self.projection is None:
+            return [self.data.get(x) for x in self._keys()]
+        return [self.results[x][1] for x in self._keys()]
+
+    def ids(self):
+        '''ids of the nodes in the results ordered by them'''
+        return [self.results[x][0] for x in self._keys()]
+
+    def _keys(self):
+        self._build()
+        if self.order is None:
+            self.order = sorted(self.results)
+        return self.order
+
+    def __len__(self):
+        self._build()
+        return len(self.results)
+
+
+class _Tolerant:
+    # predicate which does not match nodes the given one fails on, its indexes are used as they are
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __call__(self, view):
+        try:
+            return self.predicate(view)
+        except Exception:
+            return False
+
+    def candidates(self, indexes):
+        if not hasattr(self.predicate, 'candidates'):
+            return None
+        return self.predicate.candidates(indexes)
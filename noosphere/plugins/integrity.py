@@ -4,6 +4,8 @@ Data integrity checker for a flat structure database.
 
 '''
 
+from warnings import warn
+
 from noosphere import NosError
 
 def retrieve_value_type(attr_value):
@@ -24,28 +26,82 @@ def retrieve_value_type(attr_value):
     raise NosError('unrecognized data type of {}'.format(attr_value))
 
 def valid_entry(self, entry):
+    self.validate_many([entry])
+
+def validate_many(self, entries):
+    # values are gathered by attributes so that each validator runs over all of its values at once
+    columns = {}
+    for entry in entries:
+        for (attr_id, value) in entry.items():
+            columns.setdefault(attr_id, []).append(value)
     attr_type_feat = self.module('attribute_id')
-    for attr_id in entry.keys():
-        if attr_type_feat:
-            if attr_id == attr_type_feat.get('dbtype'):
-                if entry[attr_id] not in ['str', 'int', 'float', 'ref', 'bool', None]:
-                    raise NosError('dbtype has invalid value {}'.format(entry[attr_id]))
-            elif self.data.is_id(attr_id):
-                attr_type = self.get(attr_id)
-                dbtype = attr_type_feat.get('dbtype')
-                array = attr_type_feat.get('array')
-                if dbtype not in attr_type or array not in attr_type:
-                    warn('attribute {} used in an entry {} is invalid attribute type as it does not contain either "dbtype" or "array" attribute'.format(attr_type, entry))
-                else:
-                    self.valid_attribute(entry[attr_id], attr_type[dbtype], attr_type[array])
-                    continue
-            elif attr_id != 'id' and not ('id' in entry and entry['id'] == '!0'):
-                loader = self.module('loader', True)
-                name_id = loader.get('name')
-                if name_id not in entry: # means that this is not a loader
+    for (attr_id, values) in columns.items():
+        if attr_type_feat and attr_id != 'id' and not self.data.is_id(attr_id):
+            loader = self.module('loader', True)
+            name_id = loader.get('name')
+            for entry in entries:
+                if attr_id in entry and entry.get('id') != '!0' and name_id not in entry: # means that this is not a loader
                     warn('although attribute typing is enabled an entry was inserted with plain attribute name "{}"'.format(attr_id))
                     warn('entry: {}'.format(entry))
-        self.valid_attribute(entry[attr_id], None, None)
+        validate = self.attribute_validator(attr_id)
+        for value in values:
+            validate(value)
+
+def attribute_validator(self, attr_id):
+    '''returns validator of the attribute values which is cached until the attribute changes'''
+    if attr_id in self.cache.validators:
+        return self.cache.validators[attr_id]
+    attr_type_feat = self.module('attribute_id')
+    validate = _valid_untyped
+    if attr_type_feat:
+        if attr_id == attr_type_feat.get('dbtype'):
+            validate = _valid_dbtype
+        elif self.data.is_id(attr_id):
+            attr_type = self.attribute(attr_id)
+            if attr_type.dbtype is None or attr_type.array is None:
+                warn('attribute {} is invalid attribute type as it does not contain either "dbtype" or "array" attribute'.format(attr_type))
+            else:
+                validate = compile_validator(attr_type.dbtype, attr_type.array)
+    self.cache.validators[attr_id] = validate
+    return validate
+
+#== compiled validators =====================================================
+
+_type_checks = {
+    'str': lambda x: isinstance(x, str),
+    'int': lambda x: isinstance(x, int) and not isinstance(x, bool),
+    'float': lambda x: isinstance(x, float),
+    'bool': lambda x: isinstance(x, bool),
+    'ref': lambda x: isinstance(x, dict) and len(x) == 1 and 'id' in x,
+}
+
+def compile_validator(dbtype, array):
+    '''Returns function which checks that a value has the given type and raises NosError otherwise.'''
+    if dbtype not in _type_checks:
+        return lambda value: valid_attribute(None, value, dbtype, array)
+    check = _type_checks[dbtype]
+    if array:
+        def validate(value):
+            if not isinstance(value, list):
+                raise NosError('type is not array but it should be {}'.format(value))
+            for item in value:
+                if item is not None and not check(item):
+                    valid_attribute(None, value, dbtype, array) # raises the detailed error
+                    raise NosError('array {} should contain only values of type {}'.format(value, dbtype))
+    else:
+        def validate(value):
+            if value is not None and not check(value):
+                valid_attribute(None, value, dbtype, array) # raises the detailed error
+                raise NosError('value {} should have been of type {}'.format(value, dbtype))
+    return validate
+
+def _valid_untyped(value):
+    valid_attribute(None, value, None, None)
+
+def _valid_dbtype(value):
+    if value not in ['str', 'int', 'float', 'ref', 'bool', None]:
+        raise NosError('dbtype has invalid value {}'.format(value))
+    valid_attribute(None, value, None, None)
 
 def valid_attribute(self, attr_value, assumed_type, assumed_array):
     attr_type = retrieve_value_type(attr_value)
@@ -1,4 +1,6 @@
 
+from warnings import warn
+
 from noosphere import NosError
 from noosphere.utils import ref, unwrap
 
@@ -20,8 +22,8 @@ def set_other_side_of_references(self, old_entry, new_entry):
     attr_feat = self.module('attribute_id')
     links_feat = self.module('link')
     if attr_feat and links_feat:
-        old_attrs_ids = unwrap(self._relation_attributes_iterator(old_entry))
-        new_attrs_ids = unwrap(self._relation_attributes_iterator(new_entry))
+        old_attrs_ids = list(self._relation_attributes_iterator(old_entry))
+        new_attrs_ids = list(self._relation_attributes_iterator(new_entry))
         if new_entry is not None and 'id' in new_entry:
             entry_ref = ref(new_entry)
         elif old_entry is not None and 'id' in old_entry:
@@ -29,20 +31,15 @@ def set_other_side_of_references(self, old_entry, new_entry):
         else:
             raise NosError('Double-sided reference failed as both new and old entry is None or invalid')
         for attr_id in list(set(old_attrs_ids).union(set(new_attrs_ids))):
-            attr = self.get(attr_id)
-            target_attr = links_feat.get('target')
-            if target_attr not in attr:
-                continue
-            other_side_attr_ref = attr[target_attr]
-            if other_side_attr_ref:
-                array_par = attr_feat.get('array')
-                is_array = attr[array_par]
-                other_side_attr_id = unwrap(other_side_attr_ref)
-                other_side_attr = self.get(other_side_attr_id)
+            attr = self.attribute(attr_id)
+            if attr.target:
+                is_array = attr.array
+                other_side_attr_id = attr.target
+                other_side_attr = self.attribute(other_side_attr_id)
                 (inserted_node_ids, removed_node_ids) = added_removed_elements_ids(old_entry, new_entry, attr_id, is_array)
                 for inserted_node_id in inserted_node_ids:
-                    node = self.get(inserted_node_id)
-                    if other_side_attr[array_par]:
+                    node = self.view(inserted_node_id).copy() # a trusted database would return the stored node
+                    if other_side_attr.array:
                         node[other_side_attr_id].append(entry_ref)
                     else:
                         if other_side_attr_id in node and node[other_side_attr_id]:
@@ -50,8 +47,8 @@ def set_other_side_of_references(self, old_entry, new_entry):
                         node[other_side_attr_id] = entry_ref
                     self.data.update(node)
                 for removed_node_id in removed_node_ids:
-                    node = self.get(removed_node_id)
-                    if other_side_attr[array_par]:
+                    node = self.view(removed_node_id).copy()
+                    if other_side_attr.array:
                         node[other_side_attr_id].remove(entry_ref)
                     else:
                         node[other_side_attr_id] = None
@@ -64,11 +61,11 @@ def _relation_attributes_iterator(self, entity):
     if attr_type_feat:
         for attr_id in entity.keys():
             if self.data.is_id(attr_id):
-                attr = self.get(attr_id)
-                if attr_type_feat.get('dbtype') not in attr:
+                attr = self.attribute(attr_id)
+                if attr.dbtype is None:
                     warn('attribute without dbtype: {}'.format(attr))
-                elif attr[attr_type_feat.get('dbtype')] == 'ref':
-                    yield attr
+                elif attr.dbtype == 'ref':
+                    yield attr_id
 
 # compare two entries' attributes and split their differences into lists
 # of new elements and old elements
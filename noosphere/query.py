@@ -0,0 +1,141 @@
+'''
+Declarative query predicates for Graph.find.
+
+Predicates are callables which accept a node, so they may be used wherever a query lambda is expected.
+Additionally, they tell the database which nodes may satisfy them given its indexes,
+so that only those nodes are checked instead of the whole database.
+'''
+
+from noosphere.index import value_key, value_keys
+
+def _attr_id(attr):
+    if isinstance(attr, str):
+        return attr
+    return attr['id']
+
+
+class Predicate:
+    '''
+    Base of query predicates.
+    '''
+
+    def __call__(self, node):
+        raise NotImplementedError()
+
+    def candidates(self, indexes):
+        '''ids of nodes which may satisfy the predicate, None if all nodes need to be checked'''
+        return None
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+
+class Has(Predicate):
+    '''
+    Node contains the attribute.
+    '''
+
+    def __init__(self, attr):
+        self.attr_id = _attr_id(attr)
+
+    def __call__(self, node):
+        return self.attr_id in node
+
+    def candidates(self, indexes):
+        if self.attr_id in indexes:
+            return indexes[self.attr_id].having()
+        return None
+
+
+class Eq(Predicate):
+    '''
+    Attribute equals to the value, or contains it if the attribute is an array.
+    '''
+
+    def __init__(self, attr, value):
+        self.attr_id = _attr_id(attr)
+        self.value = value
+        self.key = value_key(value)
+
+    def __call__(self, node):
+        return self.attr_id in node and self.key in value_keys(node[self.attr_id])
+
+    def candidates(self, indexes):
+        if self.attr_id in indexes:
+            return indexes[self.attr_id].equal(self.value)
+        return None
+
+
+class Range(Predicate):
+    '''
+    Attribute value lies between low and high including both, a missing bound is unlimited.
+    '''
+
+    def __init__(self, attr, low=None, high=None):
+        self.attr_id = _attr_id(attr)
+        self.low = low
+        self.high = high
+        bound = low if low is not None else high
+        self.kind = None if bound is None else value_key(bound)[0]
+
+    def __call__(self, node):
+        if self.attr_id not in node:
+            return False
+        for (kind, value) in value_keys(node[self.attr_id]):
+            if self.kind is not None and kind != self.kind:
+                continue
+            if self.low is not None and value < self.low:
+                continue
+            if self.high is not None and value > self.high:
+                continue
+            return True
+        return False
+
+    def candidates(self, indexes):
+        if self.attr_id in indexes:
+            return indexes[self.attr_id].between(self.low, self.high)
+        return None
+
+
+class And(Predicate):
+    '''
+    All of the predicates hold.
+    '''
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, node):
+        return all(x(node) for x in self.predicates)
+
+    def candidates(self, indexes):
+        res = None
+        for predicate in self.predicates:
+            ids = predicate.candidates(indexes) if isinstance(predicate, Predicate) else None
+            if ids is not None:
+                res = ids if res is None else res & ids
+        return res
+
+
+class Or(Predicate):
+    '''
+    At least one of the predicates holds.
+    '''
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, node):
+        return any(x(node) for x in self.predicates)
+
+    def candidates(self, indexes):
+        res = set()
+        for predicate in self.predicates:
+            ids = predicate.candidates(indexes) if isinstance(predicate, Predicate) else None
+            if ids is None:
+                return None
+            res |= ids
+        return res
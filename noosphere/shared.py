@@ -0,0 +1,141 @@
+'''
+Graphs shared by the threads of a server.
+'''
+
+import os
+import time
+import contextlib
+import threading
+
+from noosphere import Graph
+from noosphere.data import FileDB
+
+
+class SharedGraph:
+    '''
+    Keeps the graph loaded between requests and reloads it only when its data were changed by someone else.
+    The graph may be altered only within use(), one thread at a time.
+    Readers use read() which gives a read-only graph of the state after the last write,
+    so they neither wait for writers nor see their changes half done.
+    Each state is made from the previous one and the nodes changed since, see MemoryDB.reader.
+    Results of the materialized queries of the graph are published with each state, see MaterializedView.reader.
+    '''
+
+    def __init__(self, data):
+        self.lock = threading.RLock()
+        self.graph = Graph(data)
+        self.graph.data.listeners.append(self)
+        self.state_lock = threading.Lock() # guards only the swap of the published state and counts of its readers
+        self.state = None
+        self.modified = True
+        self.changed_nodes = None # key -> (node id, node in the published state) of nodes changed since, None if all may have
+        self._publish()
+
+    @contextlib.contextmanager
+    def use(self):
+        '''exclusive access to the up-to-date graph'''
+        with self.lock:
+            if self.graph.data.stale():
+                self.graph.reload()
+            try:
+                yield self.graph
+            finally:
+                self._publish()
+
+    @contextlib.contextmanager
+    def read(self):
+        '''read-only graph of the state after the last write which later writes do not affect'''
+        self._refresh()
+        with self.state_lock:
+            state = self.state
+            state.readers += 1
+        try:
+            yield state.graph
+        finally:
+            with self.state_lock:
+                state.readers -= 1
+                retired = state.readers == 0 and state is not self.state
+            if retired:
+                state.graph.data.close()
+
+    def changes(self, after=None, predicate=None, timeout=None, poll=1.0):
+        '''
+        Pair of changes committed after the sequence number and the number to continue after, see ChangeFeed.poll.
+        Waits up to timeout seconds for a change, without the sequence number only for new ones.
+        Changes saved by other processes are noticed by checking the data every poll seconds.
+        '''
+        feed = self.graph.feed
+        self._refresh()
+        if after is None:
+            after = feed.last
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            (changes, after) = feed.poll(after, predicate)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if changes or remaining is None or remaining <= 0:
+                return (changes, after)
+            feed.wait(after, min(poll, remaining))
+            self._refresh()
+
+    def _refresh(self):
+        if self.lock.acquire(blocking=False): # the data are reloaded only if no one writes
+            try:
+                if self.graph.data.stale():
+                    self.graph.reload()
+                self._publish()
+            finally:
+                self.lock.release()
+
+    def _publish(self):
+        # called by the writer, readers keep the previous state until it is replaced
+        views = self.graph.materialized_views
+        if self.graph.data.batch_depth > 0 or not self.modified and self.state.views == views:
+            return
+        self.modified = False
+        (previous, changes) = (self.state, self.changed_nodes)
+        if previous is None or changes is None:
+            graph = Graph(self.graph.data.reader())
+        else:
+            graph = Graph(self.graph.data.reader(previous.graph.data, changes))
+            cache = previous.graph.cache
+            if not any(node_id in cache.sources or node_id == '!0' for (node_id, _) in changes.values()):
+                graph.cache = cache # readers of both states fill it, as nothing it was read from changed
+        self.changed_nodes = {}
+        graph.materialized_views = {x: y.reader(graph.data) for (x, y) in views.items()}
+        state = _State(graph, dict(views))
+        with self.state_lock:
+            (old_state, self.state) = (self.state, state)
+            retired = old_state is not None and old_state.readers == 0
+        if retired:
+            old_state.graph.data.close()
+
+    #== Listener of the data ====================================================
+
+    def changed(self, node_id, old_node, new_node):
+        self.modified = True
+        if self.changed_nodes is not None:
+            self.changed_nodes.setdefault(str(node_id), (node_id, old_node))
+
+    def reset(self):
+        self.modified = True
+        self.changed_nodes = None
+
+
+class _State:
+    # published read-only graph with the number of its readers and the materialized queries it was made with
+    def __init__(self, graph, views):
+        self.graph = graph
+        self.views = views
+        self.readers = 0
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_graph(location, database=FileDB):
+    '''Returns the shared graph of the database at the given location, it is created on the first call.'''
+    key = os.path.realpath(os.path.expanduser(location))
+    with _shared_lock:
+        if key not in _shared:
+            _shared[key] = SharedGraph(database(location))
+        return _shared[key]
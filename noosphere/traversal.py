@@ -0,0 +1,59 @@
+'''
+Traversals of the graph given by a function which returns ids of neighbours of a node.
+
+Only ids are passed around, so walking the graph never copies the nodes; see Graph.traverse and related functions.
+'''
+
+import collections
+
+
+def bfs(start, neighbours, depth=None):
+    '''Yields pairs of id and distance from the start in the breadth-first order, up to the given depth.'''
+    seen = {start}
+    queue = collections.deque([(start, 0)])
+    while queue:
+        (node_id, distance) = queue.popleft()
+        yield (node_id, distance)
+        if depth is not None and distance >= depth:
+            continue
+        for other_id in neighbours(node_id):
+            if other_id not in seen:
+                seen.add(other_id)
+                queue.append((other_id, distance + 1))
+
+
+def dfs(start, neighbours, depth=None):
+    '''Yields pairs of id and distance from the start along the path in the depth-first preorder, up to the given depth.'''
+    seen = set()
+    stack = [(start, 0)]
+    while stack:
+        (node_id, distance) = stack.pop()
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        yield (node_id, distance)
+        if depth is not None and distance >= depth:
+            continue
+        # neighbours are pushed reversed so that they are visited in their order
+        for other_id in reversed(neighbours(node_id)):
+            if other_id not in seen:
+                stack.append((other_id, distance + 1))
+
+
+def shortest_path(start, target, neighbours):
+    '''List of ids from the start to the target with the least number of edges, None if the target is unreachable.'''
+    previous = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        node_id = queue.popleft()
+        if node_id == target:
+            path = []
+            while node_id is not None:
+                path.append(node_id)
+                node_id = previous[node_id]
+            return path[::-1]
+        for other_id in neighbours(node_id):
+            if other_id not in previous:
+                previous[other_id] = node_id
+                queue.append(other_id)
+    return None